@@ -0,0 +1,114 @@
+"""メッセージ・リアクションによるポイント加算の合成リプレイ（AccrualPipeline と、それ以前の1件ずつ反映する方法の比較）
+
+    python bench_accrual.py                      # old / pipeline × 1000, 10000, 50000 件/秒
+    python bench_accrual.py pipeline 10000 3     # 方法・1秒あたりの件数・秒数を指定
+
+10 ms ごとにイベントを作る。4件に3件はメッセージ、残りはリアクション。8割は2千人の常連、2割は20万人から選ぶ。
+保存先は既定の STORAGE_BACKEND で、最後に実際に書き込む。データファイルは一時ディレクトリに作り、終わったら消す。
+"""
+import asyncio
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TICK = 0.01
+
+
+def old_accrue(bot, user_id, today, points, messages):
+    """AccrualPipeline より前の反映方法（イベントごとに反映し、変更を記録してログインボーナスを確認する）"""
+    bot.user_store.add_points(user_id, points)
+    bot.activity_log.record(user_id, today, points=points, messages=messages)
+    bot.mark_dirty()
+    bot.check_and_give_login_bonus(user_id, today)
+
+
+async def replay(bot, mode, rate, seconds):
+    random.seed(0)
+    users = [random.randint(1, 2000) if random.random() < 0.8 else random.randint(1, 200000) for _ in range(100000)]
+    bot.dm_dispatcher.send = lambda *args, **kwargs: True  # DM は送らない
+
+    apply_time = [0.0]
+    apply = bot.accrual_pipeline.apply
+
+    def timed_apply(batch):
+        started = time.perf_counter()
+        apply(batch)
+        apply_time[0] += time.perf_counter() - started
+
+    bot.accrual_pipeline.apply = timed_apply
+
+    await bot.load_data()
+    bot.accrual_pipeline.start()
+    loop = asyncio.get_running_loop()
+    today = bot.default_clock.today()
+    per_tick = rate * TICK
+    busy = 0.0  # イベントを渡す側（ハンドラに当たる部分）の時間。イベントを作る時間は含まない
+    sent = 0
+    carry = 0.0
+    k = 0
+    lag_max = 0.0
+    start = loop.time()
+    while loop.time() - start < seconds:
+        carry += per_tick
+        n = int(carry)
+        carry -= n
+        events = []
+        for _ in range(n):
+            k += 1
+            is_message = k % 4 != 0
+            events.append((users[k % len(users)], 30 if is_message else 5, 1 if is_message else 0))
+        started = time.perf_counter()
+        if mode == "old":
+            for user_id, points, messages in events:
+                old_accrue(bot, user_id, today, points, messages)
+        else:
+            push = bot.accrual_pipeline.push
+            for user_id, points, messages in events:
+                push(user_id, today, points, messages)
+        busy += time.perf_counter() - started
+        sent += n
+        expected = start + TICK * (sent / per_tick)
+        await asyncio.sleep(max(0, expected - loop.time()))
+        lag_max = max(lag_max, loop.time() - expected)
+    while not bot.accrual_pipeline.queue.empty():
+        await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    elapsed = loop.time() - start
+    await bot.flush_now()
+    work = busy + apply_time[0]
+    stats = bot.accrual_stats
+    print(f"{mode:8s} {rate:6d}/s  cost {work / sent * 1e6:5.1f} us/event ({work / elapsed * 100:4.1f}% of one core)  "
+          f"achieved {sent / elapsed:8.0f}/s  max lag {lag_max * 1000:6.1f} ms  "
+          f"batches {stats['batches']}  max_batch {stats['max_batch']}  flushes {bot.persist_stats['flushes']}")
+
+
+def run(mode, rate, seconds):
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)  # bot のデータファイルは作業ディレクトリからの相対パス
+        sys.path.insert(0, HERE)
+        logging.disable(logging.CRITICAL)
+        import bot
+        asyncio.run(replay(bot, mode, rate, seconds))
+        os.chdir(HERE)
+
+
+def main():
+    if len(sys.argv) > 1:
+        mode = sys.argv[1]
+        if mode not in ("old", "pipeline"):
+            sys.exit("mode は old か pipeline")
+        run(mode, int(sys.argv[2]) if len(sys.argv) > 2 else 10000, float(sys.argv[3]) if len(sys.argv) > 3 else 3)
+        return
+    # 状態（キュー・統計・データ）が混ざらないよう、1回ずつ別のプロセスで測る
+    for rate in (1000, 10000, 50000):
+        for mode in ("old", "pipeline"):
+            subprocess.run([sys.executable, os.path.abspath(__file__), mode, str(rate)], check=True)
+
+
+if __name__ == "__main__":
+    main()
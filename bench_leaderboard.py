@@ -0,0 +1,83 @@
+"""/ランキング の上位取得・順位・ポイント更新の速さを測るベンチマーク
+
+    python bench_leaderboard.py                # 1万・10万・100万人
+    python bench_leaderboard.py 10000 100000   # 人数を指定
+
+比較のため、Leaderboard を使う前の方法（全員から heapq で上位を選ぶ、SQLite の points 索引で上位を引く）も測る。
+データファイルは一時ディレクトリに作り、終わったら消す。
+"""
+import heapq
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+logging.disable(logging.CRITICAL)
+import bot  # noqa: E402
+
+
+def per_call_ms(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def bench(n, workdir):
+    random.seed(n)
+    store = bot.UserStore()
+    for _ in range(n):
+        store.set_user(random.getrandbits(60), random.randint(0, 10 ** 6))
+    store.dirty.clear()
+    results = {}
+
+    # 変更前: 全員のポイントから上位5人を選ぶ（以前の UserStore.top_points と同じ方法）
+    exclude = bot.ADMIN_USER_IDS
+    ids, points = store.user_ids, store.points
+
+    def top_points(limit):
+        top = heapq.nlargest(limit + len(exclude), range(len(points)), key=points.__getitem__)
+        return [(ids[i], points[i]) for i in top if ids[i] not in exclude][:limit]
+
+    results["heapq top5"] = per_call_ms(lambda: top_points(5), 5)
+
+    # 変更前: SQLite の points 索引で上位5人を引く（保存と I/O スレッドへの受け渡しは含まない）
+    storage = bot.SqliteStorage(os.path.join(workdir, f"bench_{n}.db"))
+    storage.connect()
+    storage.write_batch(tuple(store.rows()))
+    conn = storage.conn
+    results["sqlite top5"] = per_call_ms(
+        lambda: conn.execute("SELECT user_id, points FROM users ORDER BY points DESC, user_id LIMIT 5").fetchall(), 50)
+    storage.close()
+
+    # 変更後: Leaderboard（読み込み後の一括構築、上位5人、ポイント更新、順位）
+    store.leaderboard = bot.Leaderboard(exclude)
+    started = time.perf_counter()
+    store.rebuild_leaderboard()
+    results["build"] = (time.perf_counter() - started) * 1000
+    results["top5"] = per_call_ms(lambda: store.leaderboard.top(5), 1000)
+    sample = random.sample(list(store.index), min(1000, n))
+    started = time.perf_counter()
+    for user_id in sample:
+        store.add_points(user_id, 30)
+    results["update"] = (time.perf_counter() - started) / len(sample) * 1000
+    started = time.perf_counter()
+    for user_id in sample:
+        store.leaderboard.rank(user_id, store.get_points(user_id))
+    results["rank"] = (time.perf_counter() - started) / len(sample) * 1000
+    return results
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000, 1_000_000]
+    with tempfile.TemporaryDirectory() as workdir:
+        for n in sizes:
+            results = bench(n, workdir)
+            print(f"{n:>9,d} 人  " + "  ".join(f"{name} {value:.3f} ms" for name, value in results.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""/ランキング の表示名の解決にかかる時間を、遅延を入れた偽の REST サーバーに対して測るベンチマーク
+
+    python bench_names.py            # 遅延 0.3 秒と 2 秒
+    python bench_names.py 0.1 1.5    # 遅延（秒）を指定
+
+ボットの HTTP クライアントの接続先を、GET /users/{id} だけを真似るローカルの aiohttp サーバーに向け、
+メンバーキャッシュにいない上位5人について /ランキング のコールバックを最後まで呼ぶ。
+比べるのは、以前の1人ずつ順に fetch_user する方法、キャッシュが空・有効・期限切れのときの今の方法。
+name_cache.json などは一時ディレクトリに作り、終わったら消す。
+"""
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import discord
+from aiohttp import web
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeInteraction:
+    """コールバックが使う部分だけを持つ Interaction の代わり"""
+
+    guild = None
+    guild_id = None
+
+    def __init__(self):
+        self.sent = None
+        self.response = self
+
+    async def send_message(self, content, ephemeral=False):
+        self.sent = content
+
+
+async def serial_ranking(bot):
+    """以前の /ランキング と同じく、上位のユーザーを1人ずつ順に REST で取得する"""
+    names = []
+    for user_id, _ in bot.user_store.leaderboard.top(5):
+        try:
+            names.append((await bot.bot.fetch_user(user_id)).name)
+        except discord.HTTPException:
+            names.append("Unknown User")
+    return names
+
+
+async def timed_ms(coro):
+    started = time.perf_counter()
+    await coro
+    return (time.perf_counter() - started) * 1000
+
+
+async def wait_background_fetches(bot):
+    """時間切れのあと裏で続いている取得を待つ（次の計測に混ざらないように）"""
+    while bot.name_fetch_tasks:
+        await asyncio.gather(*bot.name_fetch_tasks.values(), return_exceptions=True)
+
+
+async def bench(bot, latencies):
+    latency = [0.0]
+
+    async def get_user(request):
+        user_id = request.match_info["user_id"]
+        if user_id == "@me":
+            user_id = "1"
+        else:
+            await asyncio.sleep(latency[0])
+        body = {"id": user_id, "username": f"user{user_id}", "discriminator": "0", "avatar": None, "global_name": None}
+        # discord.py は content-type が application/json のときだけ JSON として読み、レート制限のヘッダーで順番待ちを決める
+        return web.Response(body=json.dumps(body), headers={
+            "content-type": "application/json", "X-RateLimit-Limit": "50", "X-RateLimit-Remaining": "49",
+            "X-RateLimit-Reset-After": "1", "X-RateLimit-Bucket": "users",
+        })
+
+    app = web.Application()
+    app.router.add_get("/api/v10/users/{user_id}", get_user)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    discord.http.Route.BASE = f"http://127.0.0.1:{port}/api/v10"
+    await bot.bot.http.static_login("bench")
+
+    for i in range(1, 11):
+        bot.user_store.add_points(1000 + i, i * 10)
+    ranking = bot.ranking.callback
+    try:
+        for value in latencies:
+            latency[0] = value
+            bot.name_cache.names.clear()
+            before = await timed_ms(serial_ranking(bot))
+            cold = await timed_ms(ranking(FakeInteraction()))
+            await wait_background_fetches(bot)
+            warm = await timed_ms(ranking(FakeInteraction()))
+            for user_id, (name, fetched_at) in list(bot.name_cache.names.items()):
+                bot.name_cache.names[user_id] = (name, fetched_at - bot.NAME_CACHE_TTL_SECONDS)
+            interaction = FakeInteraction()
+            expired = await timed_ms(ranking(interaction))
+            await wait_background_fetches(bot)
+            stale = "Unknown User" not in interaction.sent
+            print(f"遅延 {value:.1f} s  以前（順に取得） {before:6.0f} ms  空 {cold:6.0f} ms  有効 {warm:6.1f} ms  "
+                  f"期限切れ {expired:6.0f} ms（{'古い名前で表示' if stale else 'Unknown User で表示'}）")
+    finally:
+        await bot.bot.http.close()
+        await runner.cleanup()
+
+
+def main():
+    latencies = [float(arg) for arg in sys.argv[1:]] or [0.3, 2.0]
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)  # bot のデータファイルは作業ディレクトリからの相対パス
+        sys.path.insert(0, HERE)
+        logging.disable(logging.CRITICAL)
+        import bot
+        asyncio.run(bench(bot, latencies))
+        os.chdir(HERE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""起動時のデータ読み込み（バイナリスナップショットと user_data.json）の時間とメモリを測るベンチマーク
+
+    python bench_snapshot.py              # 100万人
+    python bench_snapshot.py 100000       # 人数を指定
+
+合成したユーザーを両方の形式で一時ディレクトリに書き出し、形式ごとに別のプロセスで
+SnapshotStorage.read_state()（起動時と同じ読み込み）を行って、時間と最大RSSを測る。終わったらファイルは消す。
+"""
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def peak_rss_mb():
+    # Linux の ru_maxrss はキロバイト単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_files(n):
+    """n 人分の合成データを user_data.bin と user_data.json に書く"""
+    import bot
+    random.seed(n)
+    today = bot.default_clock.today()
+    store = bot.UserStore()
+    for _ in range(n):
+        store.set_user(random.getrandbits(60), random.randint(0, 10 ** 6), random.randint(0, 9), today - random.randint(0, 60))
+    bot.write_binary_snapshot(bot.SNAPSHOT_FILE, store, 0)
+    bot.write_json_state(bot.DATA_FILE, store)
+
+
+def load(kind):
+    """kind の形式だけが置かれた状態で起動時の読み込みを行い、結果を1行で表示する"""
+    import bot
+    if kind == "json":
+        os.rename(bot.SNAPSHOT_FILE, bot.SNAPSHOT_FILE + ".off")  # .bin がなければ user_data.json を読む
+    baseline = peak_rss_mb()
+    started = time.perf_counter()
+    state = bot.SnapshotStorage(bot.SNAPSHOT_FILE, bot.DELTA_FILE).read_state()
+    elapsed = time.perf_counter() - started
+    path = bot.DATA_FILE if kind == "json" else bot.SNAPSHOT_FILE
+    print(f"{kind:5s} {os.path.getsize(path) / 1e6:6.1f} MB  {len(state):,d} 人  {elapsed:6.2f} s  "
+          f"最大RSS {peak_rss_mb():6.0f} MB（読み込み前 {baseline:.0f} MB）")
+    if kind == "json":
+        os.rename(bot.SNAPSHOT_FILE + ".off", bot.SNAPSHOT_FILE)
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--child":
+        # 子プロセス: 作業ディレクトリは親が用意した一時ディレクトリ
+        sys.path.insert(0, HERE)
+        logging.disable(logging.CRITICAL)
+        if sys.argv[2] == "write":
+            write_files(int(sys.argv[3]))
+        else:
+            load(sys.argv[2])
+        return
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    with tempfile.TemporaryDirectory() as workdir:
+        # 書き出しと読み込みのメモリが混ざらないよう、それぞれ別のプロセスで行う
+        child = [sys.executable, os.path.abspath(__file__), "--child"]
+        subprocess.run(child + ["write", str(n)], cwd=workdir, check=True)
+        for kind in ("json", "bin"):
+            subprocess.run(child + [kind], cwd=workdir, check=True)
+
+
+if __name__ == "__main__":
+    main()
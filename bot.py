@@ -1,13 +1,29 @@
 import discord
 from discord import app_commands
 from discord.ext import commands
-from collections import defaultdict
+import asyncio
+import bisect
+import collections
 import datetime
+import functools
+import hashlib
+import secrets
+import heapq
+import math
 import json
+import mmap
 import os
+import random
+import sqlite3
+from array import array
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 import logging
+from aiohttp import web
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from pytz import timezone
 
 logging.basicConfig(level=logging.INFO)
@@ -16,7 +32,61 @@ logging.basicConfig(level=logging.INFO)
 DISCORD_BOT_TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 
 # データファイルのパス
-DATA_FILE = "user_data.json"
+DATA_FILE = "user_data.json"  # JSON形式（取り込み・書き出し用）
+SNAPSHOT_FILE = "user_data.bin"  # バイナリ形式のスナップショット
+DELTA_FILE = "user_data.delta"  # 変更されたユーザーだけを書く差分ファイル（番号付きで分割）
+DB_FILE = "user_data.db"
+ACTIVITY_FILE = "activity.bin"  # 期間別ランキング用の日別の記録
+
+# 保存先: "sqlite"（既定）または "file"（ベーススナップショット + 差分ファイル）
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+COMPACT_INTERVAL_SECONDS = float(os.getenv("COMPACT_INTERVAL_SECONDS", "600"))
+
+# 書き込み遅延（write-behind）の設定: 一定間隔または変更件数がしきい値に達したらまとめて保存
+SAVE_INTERVAL_SECONDS = float(os.getenv("SAVE_INTERVAL_SECONDS", "15"))
+SAVE_DIRTY_THRESHOLD = int(os.getenv("SAVE_DIRTY_THRESHOLD", "500"))
+
+# 表示名キャッシュ: ランキングで使うユーザー名を覚えておき、REST の呼び出しを減らす
+NAME_CACHE_FILE = "name_cache.json"
+
+# コマンドの同期: 前回同期したコマンドのハッシュを覚えておき、変わったときだけ同期する
+COMMAND_SYNC_FILE = "command_sync.json"
+COMMAND_SYNC_GUILD_ID = os.getenv("COMMAND_SYNC_GUILD_ID")  # 設定するとこのサーバーだけに同期する（開発用、すぐ反映される）
+COMMAND_SYNC_FORCE = os.getenv("COMMAND_SYNC_FORCE") == "1"  # ハッシュが同じでも同期する
+NAME_CACHE_TTL_SECONDS = float(os.getenv("NAME_CACHE_TTL_SECONDS", "86400"))
+NAME_FETCH_CONCURRENCY = int(os.getenv("NAME_FETCH_CONCURRENCY", "5"))
+NAME_FETCH_TIMEOUT = float(os.getenv("NAME_FETCH_TIMEOUT", "1.0"))  # これより遅ければキャッシュの名前で返す
+
+# DM の送信キュー: イベント処理を待たせないよう、DM は裏で順番に送る
+DM_QUEUE_SIZE = int(os.getenv("DM_QUEUE_SIZE", "1000"))  # 送信待ちのユーザー数の上限（超えたら捨てる）
+DM_WORKERS = int(os.getenv("DM_WORKERS", "4"))  # 同時に送る数
+DM_CHANNEL_CACHE_SIZE = int(os.getenv("DM_CHANNEL_CACHE_SIZE", "10000"))
+DM_USER_CACHE_SIZE = int(os.getenv("DM_USER_CACHE_SIZE", "10000"))  # REST で取得したユーザーなどを覚えておく数
+DM_CLOSED_CACHE_SIZE = int(os.getenv("DM_CLOSED_CACHE_SIZE", "10000"))  # DM を受け取れないと覚えておくユーザー数
+DM_CLOSED_TTL_SECONDS = float(os.getenv("DM_CLOSED_TTL_SECONDS", "21600"))  # DM を受け取れないユーザーに再び送ってみるまでの秒数
+DM_CLOSED_MAX_TTL_SECONDS = 7 * 86400  # 失敗が続くと間隔を倍にしていく上限
+DM_DRAIN_TIMEOUT = 5.0  # 終了時に送信待ちを送り切るまで待つ秒数
+
+# ポイント加算のキュー: メッセージとリアクションのイベントをまとめて反映する
+ACCRUAL_QUEUE_SIZE = int(os.getenv("ACCRUAL_QUEUE_SIZE", "100000"))  # いっぱいのときはその場で反映する
+ACCRUAL_BATCH_SIZE = int(os.getenv("ACCRUAL_BATCH_SIZE", "5000"))  # 1回にまとめて反映するイベント数の上限
+ACCRUAL_INTERVAL = float(os.getenv("ACCRUAL_INTERVAL", "0.05"))  # 反映したあと次を反映するまで待つ秒数（この間のイベントがまとまる）
+# ポイントが付くイベントの上限（トークンバケット: 1秒あたりの回復量と最大量。0なら制限なし）
+MESSAGE_RATE = float(os.getenv("MESSAGE_RATE", "0.2"))  # ユーザーごとのメッセージ
+MESSAGE_BURST = float(os.getenv("MESSAGE_BURST", "10"))
+REACTION_RATE = float(os.getenv("REACTION_RATE", "0.5"))  # ユーザーごとのリアクション
+REACTION_BURST = float(os.getenv("REACTION_BURST", "20"))
+CHANNEL_RATE = float(os.getenv("CHANNEL_RATE", "5"))  # チャンネルごとのメッセージとリアクションの合計
+CHANNEL_BURST = float(os.getenv("CHANNEL_BURST", "50"))
+DEDUPE_WINDOW = int(os.getenv("DEDUPE_WINDOW", "50000"))  # 重複を見分けるために覚えておく直近のイベント数（0なら見分けない）
+
+# ヘルスチェック用のHTTPサーバー（ボットと同じイベントループで動かす）
+HTTP_HOST = os.getenv("HTTP_HOST", "0.0.0.0")
+HTTP_PORT = int(os.getenv("HTTP_PORT", "8000"))
+API_SNAPSHOT_INTERVAL = float(os.getenv("API_SNAPSHOT_INTERVAL", "5"))  # 読み取り用APIのスナップショットを作り直す間隔（変更があるときだけ）
+API_MAX_LIMIT = 100  # ランキングのAPIで1回に返す最大件数
+API_CORS_ORIGIN = os.getenv("API_CORS_ORIGIN")  # 設定するとAPIの応答に Access-Control-Allow-Origin を付ける
+READY_MAX_FLUSH_AGE = float(os.getenv("READY_MAX_FLUSH_AGE", str(max(60.0, SAVE_INTERVAL_SECONDS * 4))))  # 未保存の変更があるのにこれより長く保存できていなければ準備できていないとみなす
 
 # 管理者のユーザーID
 ADMIN_USER_IDS = {720219524531748884}  # ここに管理者のユーザーIDを追加
@@ -28,190 +98,2090 @@ intents.message_content = True  # メッセージ内容のインテントを有
 intents.guilds = True
 intents.reactions = True  # リアクションのインテントを有効にする
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class PointCommandTree(app_commands.CommandTree):
+    """スラッシュコマンドの処理時間と失敗を記録する"""
 
-# ポイントとデータを保存する辞書
-user_points = defaultdict(int)
-last_login_date = defaultdict(lambda: None)  # ユーザーの最終ログイン日を保存する辞書
-login_streaks = defaultdict(int)  # 連続ログイン日数を保存する辞書
-monthly_message_count = defaultdict(int)  # 1ヶ月のメッセージ数を保存する辞書
+    async def interaction_check(self, interaction):
+        interaction.extras["started"] = time.perf_counter()
+        return True
 
-current_date = datetime.datetime.now(timezone("Asia/Tokyo")).date()
+    async def on_error(self, interaction, error):
+        if interaction.command is not None:
+            histogram, errors = metrics_for_command(interaction.command.qualified_name)
+            errors.inc()
+            histogram.observe(time.perf_counter() - interaction.extras.get("started", time.perf_counter()))
+        await super().on_error(interaction, error)
 
-def save_data():
-    """ポイントとデータを保存"""
-    data = {
-        "user_points": dict(user_points),
-        "last_login_date": {str(k): str(v) for k, v in last_login_date.items()},
-        "login_streaks": dict(login_streaks),
-        "monthly_message_count": dict(monthly_message_count)
-    }
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f)
-    logging.info("データが保存されました: %s", data)
+class PointBot(commands.Bot):
+    async def setup_hook(self):
+        # ログイン後・ゲートウェイに接続する前に1回だけ呼ばれる。
+        # 最初のイベントが届く前にデータを読み込み、裏の処理を始めておく（再接続で on_ready が何度呼ばれても関係ない）
+        instrument_http(self.http)
+        await start_services()
+
+    async def close(self):
+        if scheduler.running:
+            scheduler.shutdown(wait=False)  # 終了処理の途中で定期処理が動かないように最初に止める
+        await stop_http_server()
+        api_executor.shutdown(wait=False, cancel_futures=True)
+        await accrual_pipeline.close()  # 反映待ちのポイントを反映する
+        await dm_dispatcher.close()  # 送信待ちの DM を送ってから閉じる
+        accrual_pipeline.stopped = True  # ゲートウェイはまだつながっているが、最後の保存の後に届く加算は保存できないので捨てる
+        await close_storage()  # 終了前に未保存の変更を書き込む
+        await super().close()
+
+bot = PointBot(command_prefix="!", intents=intents, tree_cls=PointCommandTree)
+
+def period_start(period, day):
+    """day（序数）を含む日・週・月の最初の日の序数"""
+    if period == "weekly":
+        return day - (day - 1) % 7
+    if period == "monthly":
+        return datetime.date.fromordinal(day).replace(day=1).toordinal()
+    return day
+
+class LeaderboardNode:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, levels):
+        self.key = key
+        self.next = [None] * levels
+        self.width = [0] * levels  # next までに何件進むか
+
+class Leaderboard:
+    """ポイント順のランキング（幅付きスキップリスト）。キーは (-ポイント, ユーザーID) で、
+    更新と順位の検索は O(log n)、上位K件は O(K)"""
+
+    MAX_LEVELS = 24
+
+    def __init__(self, exclude=()):
+        self.exclude = frozenset(exclude)  # ランキングに載せないユーザー（管理者）
+        self.version = 0  # 内容が変わるたびに増える（ページ表示のキャッシュに使う）
+        self.clear()
+
+    def clear(self):
+        self.tail = LeaderboardNode((math.inf,), 0)
+        self.head = LeaderboardNode(None, self.MAX_LEVELS)
+        self.head.next = [self.tail] * self.MAX_LEVELS
+        self.head.width = [1] * self.MAX_LEVELS
+        self.size = 0
+        self.version += 1
+
+    def __len__(self):
+        return self.size
+
+    def random_levels(self):
+        # 下位ビットから続く1の数 + 1（1/2 ずつ確率が下がる）
+        bits = random.getrandbits(self.MAX_LEVELS - 1)
+        return (~bits & (bits + 1)).bit_length()
+
+    def insert(self, key):
+        chain = [None] * self.MAX_LEVELS
+        steps_at_level = [0] * self.MAX_LEVELS
+        node = self.head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key <= key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        levels = self.random_levels()
+        new_node = LeaderboardNode(key, levels)
+        steps = 0
+        for level in range(levels):
+            prev = chain[level]
+            new_node.next[level] = prev.next[level]
+            prev.next[level] = new_node
+            new_node.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(levels, self.MAX_LEVELS):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain = [None] * self.MAX_LEVELS
+        node = self.head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+        target = chain[0].next[0]
+        if target.key != key:
+            raise KeyError(key)
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), self.MAX_LEVELS):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def add(self, user_id, points):
+        if user_id not in self.exclude:
+            self.insert((-points, user_id))
+            self.version += 1
+
+    def move(self, user_id, old_points, new_points):
+        """ユーザーのポイントが old_points から new_points に変わったことを反映"""
+        if old_points != new_points and user_id not in self.exclude:
+            self.remove((-old_points, user_id))
+            self.insert((-new_points, user_id))
+            self.version += 1
+
+    def build(self, entries):
+        """(ユーザーID, ポイント) の一覧からまとめて作り直す（並べ替え1回 + O(n)）"""
+        keys = sorted((-points, user_id) for user_id, points in entries if user_id not in self.exclude)
+        self.clear()
+        last = [self.head] * self.MAX_LEVELS
+        last_position = [0] * self.MAX_LEVELS
+        for position, key in enumerate(keys, 1):
+            node = LeaderboardNode(key, self.random_levels())
+            for level in range(len(node.next)):
+                last[level].next[level] = node
+                last[level].width[level] = position - last_position[level]
+                last[level] = node
+                last_position[level] = position
+        for level in range(self.MAX_LEVELS):
+            last[level].next[level] = self.tail
+            last[level].width[level] = len(keys) + 1 - last_position[level]
+        self.size = len(keys)
+
+    def rank(self, user_id, points):
+        """順位（1始まり）を返す。ランキングに載っていなければ None"""
+        key = (-points, user_id)
+        node = self.head
+        position = 0
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.next[level].key <= key:
+                position += node.width[level]
+                node = node.next[level]
+        return position if node.key == key else None
+
+    def entries(self, start, count):
+        """start 番目（0始まり）から count 件の (ユーザーID, ポイント) を返す"""
+        if start >= self.size or count <= 0:
+            return []
+        node = self.head
+        remaining = start + 1
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+        result = []
+        while node is not self.tail and len(result) < count:
+            result.append((node.key[1], -node.key[0]))
+            node = node.next[0]
+        return result
+
+    def top(self, count):
+        return self.entries(0, count)
+
+class UserStore:
+    """ユーザーごとのポイントとデータ。ユーザーIDを連番に変換し、各項目を型付き配列に並べて持つ。
+    日・週・月のメッセージ数は ActivityLog が日別に持つ"""
+
+    COLUMNS = (
+        ("user_ids", "Q"),
+        ("points", "q"),
+        ("streaks", "i"),  # 連続ログイン日数
+        ("last_login", "i"),  # 最終ログイン日の序数（0はなし）
+    )
+
+    def __init__(self):
+        self.index = {}  # ユーザーID -> 連番
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array(typecode))
+        self.dirty = set()  # 前回の保存以降に変更されたユーザーの連番
+        self.leaderboard = None  # 設定されていればポイントの変更をランキングに反映する
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def columns(self):
+        return tuple(getattr(self, name) for name, _ in self.COLUMNS)
+
+    def slot(self, user_id):
+        """ユーザーの連番を返す（初めてのユーザーなら追加する）"""
+        i = self.index.get(user_id)
+        if i is None:
+            i = len(self.user_ids)
+            self.index[user_id] = i
+            self.user_ids.append(user_id)
+            for column in self.columns()[1:]:
+                column.append(0)
+            if self.leaderboard is not None:
+                self.leaderboard.add(user_id, 0)
+        return i
+
+    def get_points(self, user_id):
+        i = self.index.get(user_id)
+        return 0 if i is None else self.points[i]
+
+    def add_points(self, user_id, delta):
+        i = self.slot(user_id)
+        old_points = self.points[i]
+        self.points[i] = old_points + delta
+        self.dirty.add(i)
+        if self.leaderboard is not None:
+            self.leaderboard.move(user_id, old_points, old_points + delta)
+        return old_points + delta
+
+    def get_login(self, user_id):
+        """(最終ログイン日の序数（0はなし）, 連続日数) を返す"""
+        i = self.index.get(user_id)
+        if i is None:
+            return 0, 0
+        return self.last_login[i], self.streaks[i]
+
+    def set_login(self, user_id, day, streak):
+        i = self.slot(user_id)
+        self.last_login[i] = day
+        self.streaks[i] = streak
+        self.dirty.add(i)
+
+    def set_user(self, user_id, *values):
+        """ユーザーの行をまとめて設定する（値の順番は COLUMNS の2番目以降）"""
+        i = self.slot(user_id)
+        old_points = self.points[i]
+        for column, value in zip(self.columns()[1:], values):
+            column[i] = value
+        self.dirty.add(i)
+        if self.leaderboard is not None:
+            self.leaderboard.move(user_id, old_points, self.points[i])
+
+    def take_changed_rows(self):
+        """前回以降に変更されたユーザーの行を取り出し、変更の記録を空にする"""
+        columns = self.columns()
+        rows = tuple(tuple(column[i] for column in columns) for i in self.dirty)
+        self.dirty = set()
+        return rows
+
+    def mark_changed(self, rows):
+        """書き込めなかった行のユーザーを再び変更ありにする"""
+        for row in rows:
+            self.dirty.add(self.index[row[0]])
+
+    def rows(self):
+        """COLUMNS の順に並べた行を返す"""
+        return zip(*self.columns())
+
+    def copy(self):
+        other = UserStore()
+        other.index = dict(self.index)
+        for name, _ in self.COLUMNS:
+            setattr(other, name, getattr(self, name)[:])
+        return other
+
+    def merge(self, other):
+        """other の内容で上書きする（空なら配列とランキングをそのまま引き継ぐ）"""
+        if not self.index:
+            leaderboard = self.leaderboard
+            self.__dict__.update(other.__dict__)
+            if self.leaderboard is None:
+                self.leaderboard = leaderboard
+                self.rebuild_leaderboard()
+            return
+        for row in other.rows():
+            self.set_user(*row)
+
+    def rebuild_leaderboard(self):
+        if self.leaderboard is not None:
+            self.leaderboard.build(zip(self.user_ids, self.points))
+
+# Prometheus 形式のメトリクス（/metrics）。計測する場所ではあらかじめ作ったオブジェクトの数値を足すだけにし、
+# 文字列にするのは /metrics が読まれたときだけにする
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)  # 秒
+SLOW_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # 秒
+
+metric_families = {}  # 名前 -> [種類, 説明, [メトリクス]]
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels):
+    return ",".join(f'{key}="{escape_label(value)}"' for key, value in labels.items())
+
+def register_metric(name, kind, help_text, metric):
+    family = metric_families.setdefault(name, [kind, help_text, []])
+    family[2].append(metric)
+
+class Counter:
+    __slots__ = ("labels", "value")
+
+    def __init__(self, name, help_text, **labels):
+        self.labels = format_labels(labels)
+        self.value = 0
+        register_metric(name, "counter", help_text, self)
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def render(self, name):
+        yield f"{name}{{{self.labels}}} {self.value}" if self.labels else f"{name} {self.value}"
+
+class Histogram:
+    __slots__ = ("labels", "buckets", "counts", "sum", "count")
+
+    def __init__(self, name, help_text, buckets, **labels):
+        self.labels = format_labels(labels)
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 各バケットに入った数（最後は +Inf）。累積は出力するときに計算する
+        self.sum = 0.0
+        self.count = 0
+        register_metric(name, "histogram", help_text, self)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name):
+        prefix = self.labels + "," if self.labels else ""
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}'
+        suffix = f"{{{self.labels}}}" if self.labels else ""
+        yield f"{name}_sum{suffix} {self.sum}"
+        yield f"{name}_count{suffix} {self.count}"
+
+def timed(histogram):
+    """非同期関数の実行時間を histogram に記録する"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+on_message_seconds = Histogram("bot_event_handler_seconds", "イベント処理にかかった時間", FAST_BUCKETS, event="on_message")
+on_reaction_seconds = Histogram("bot_event_handler_seconds", "イベント処理にかかった時間", FAST_BUCKETS, event="on_raw_reaction_add")
+save_seconds = Histogram("bot_save_seconds", "変更の書き込みにかかった時間", SLOW_BUCKETS)
+save_rows = Counter("bot_save_rows_total", "書き込んだユーザーの行数")
+save_bytes = Counter("bot_save_bytes_total", "書き込んだバイト数（ファイル形式の保存先のみ）")
+save_failures = Counter("bot_save_failures_total", "書き込みに失敗した回数")
+load_seconds = Histogram("bot_load_seconds", "データの読み込みにかかった時間", SLOW_BUCKETS)
+dm_sent = Counter("bot_dm_sent_total", "送った DM の数")
+dm_failed = Counter("bot_dm_failed_total", "送れなかった DM の数")
+dm_latency_seconds = Histogram("bot_dm_latency_seconds", "DM をキューに入れてから送り終わるまでの時間", SLOW_BUCKETS)
+loop_lag_seconds = Histogram("bot_loop_lag_seconds", "イベントループが止まっていた時間", FAST_BUCKETS)
+
+# コマンドと REST のメトリクスはラベル（コマンド名・ルート）ごとに初めて使うときに作る
+command_metrics = {}  # コマンド名 -> (処理時間, 失敗回数)
+rest_metrics = {}  # (メソッド, ルート) -> (処理時間, 失敗回数)
+
+def metrics_for_command(name):
+    metrics = command_metrics.get(name)
+    if metrics is None:
+        metrics = command_metrics[name] = (
+            Histogram("bot_command_seconds", "スラッシュコマンドの処理にかかった時間", SLOW_BUCKETS, command=name),
+            Counter("bot_command_errors_total", "スラッシュコマンドが失敗した回数", command=name),
+        )
+    return metrics
+
+def metrics_for_route(method, path):
+    metrics = rest_metrics.get((method, path))
+    if metrics is None:
+        metrics = rest_metrics[(method, path)] = (
+            Histogram("bot_rest_request_seconds", "Discord の REST API の呼び出しにかかった時間", SLOW_BUCKETS, method=method, route=path),
+            Counter("bot_rest_errors_total", "Discord の REST API の呼び出しが失敗した回数", method=method, route=path),
+        )
+    return metrics
+
+def instrument_http(http):
+    """REST の呼び出しをルート（/channels/{channel_id}/messages など）ごとに数える"""
+    request = http.request
+
+    async def instrumented_request(route, **kwargs):
+        histogram, errors = metrics_for_route(route.method, route.path)
+        started = time.perf_counter()
+        try:
+            return await request(route, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started)
+
+    http.request = instrumented_request
+
+
+# ポイントとデータ
+user_store = UserStore()
+user_store.leaderboard = Leaderboard(exclude=ADMIN_USER_IDS)
+
+# 期間別ランキング用の記録ファイルの形式（リトルエンディアン）
+ACTIVITY_MAGIC = b"WKAC"
+ACTIVITY_VERSION = 1
+ACTIVITY_HEADER = struct.Struct("<4sHHQ")  # マジック, バージョン, 日数, 件数
+ACTIVITY_USER_ID = struct.Struct("<Q")  # 各ユーザーはユーザーIDのあとにバケットの配列が続く
+
+class ActivityLog:
+    """ユーザーごとに直近 DAYS 日分の獲得ポイント（メッセージ・リアクション・ログインボーナス）とメッセージ数を日別のバケットで持つ（リングバッファ）。
+    バケットの位置は 日の序数 % DAYS。古いバケットは次に書き込むときに0に戻すので、全員分を走査しない。
+    日ごとに活動したユーザーの集合も持ち、期間のランキングはその期間に活動したユーザーだけを集計する"""
 
-def load_data():
-    """ポイントとデータを読み込む"""
-    global user_points, last_login_date, login_streaks, monthly_message_count
+    DAYS = 31  # 月間ランキングに必要な日数
+
+    def __init__(self, exclude=()):
+        self.exclude = frozenset(exclude)  # ランキングに載せないユーザー（管理者）
+        # user_id -> array('i', [最後に記録した日の序数, 獲得ポイント * DAYS, メッセージ数 * DAYS])
+        self.buckets = {}
+        self.active = [None] * self.DAYS  # 位置 -> (日の序数, その日に活動したユーザーIDの集合)
+        self.version = 0  # 内容が変わるたびに増える
+        self.changed = False
+        self.top_cache = {}  # (種類, 開始日, 終了日, 件数) -> (version, 結果)
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def active_users(self, day):
+        """day に活動したユーザーの集合（古すぎる日なら None）。必要なら位置を新しい日に入れ替える"""
+        position = day % self.DAYS
+        entry = self.active[position]
+        if entry is None or entry[0] < day:
+            if entry is not None:
+                self.expire(entry)
+            entry = self.active[position] = (day, set())
+        elif entry[0] > day:
+            return None
+        return entry[1]
+
+    def expire(self, entry):
+        """入れ替えで消える日に活動したユーザーのうち、それ以降に活動のないユーザーの記録を捨てる"""
+        day, user_ids = entry
+        for user_id in user_ids:
+            buffer = self.buckets.get(user_id)
+            if buffer is not None and buffer[0] <= day:
+                del self.buckets[user_id]
+
+    def record(self, user_id, day, points=0, messages=0):
+        """day（序数）の獲得ポイントとメッセージ数を加算する"""
+        users = self.active_users(day)
+        if users is None:
+            return
+        days = self.DAYS
+        buffer = self.buckets.get(user_id)
+        if buffer is None:
+            buffer = self.buckets[user_id] = array("i", bytes(4 * (1 + 2 * days)))
+            buffer[0] = day
+        elif day > buffer[0]:
+            # 前回から day までの間のバケットは古い日のものなので0に戻す
+            for d in range(max(buffer[0] + 1, day - days + 1), day + 1):
+                buffer[1 + d % days] = 0
+                buffer[1 + days + d % days] = 0
+            buffer[0] = day
+        elif day <= buffer[0] - days:
+            return
+        position = day % days
+        buffer[1 + position] += points
+        buffer[1 + days + position] += messages
+        users.add(user_id)
+        self.version += 1
+        self.changed = True
+
+    @staticmethod
+    def window_sum(buffer, offset, start, end):
+        """バケットの start から end まで（序数、両端を含む）の合計。位置は連続した範囲2つまでになる"""
+        days = ActivityLog.DAYS
+        low, high = max(start, buffer[0] - days + 1), min(end, buffer[0])
+        if low > high:
+            return 0
+        first, last = offset + low % days, offset + high % days
+        if first <= last:
+            return sum(buffer[first:last + 1])
+        return sum(buffer[first:offset + days]) + sum(buffer[offset:last + 1])
+
+    def totals(self, user_id, start, end):
+        """start から end まで（序数、両端を含む）の (獲得ポイント, メッセージ数) を返す"""
+        buffer = self.buckets.get(user_id)
+        if buffer is None:
+            return 0, 0
+        return self.window_sum(buffer, 1, start, end), self.window_sum(buffer, 1 + self.DAYS, start, end)
+
+    def top(self, kind, start, end, count):
+        """start から end までの獲得ポイント（kind="points"）またはメッセージ数（kind="messages"）の
+        上位 count 人を [(ユーザーID, 値)] で返す。内容が変わるまでは結果を使い回す"""
+        key = (kind, start, end, count)
+        cached = self.top_cache.get(key)
+        if cached is not None and cached[0] == self.version:
+            return cached[1]
+        candidates = set()
+        for d in range(max(start, end - self.DAYS + 1), end + 1):
+            entry = self.active[d % self.DAYS]
+            if entry is not None and entry[0] == d:
+                candidates |= entry[1]
+        candidates -= self.exclude
+        offset = 1 if kind == "points" else 1 + self.DAYS
+        buckets = self.buckets
+        scored = ((user_id, self.window_sum(buckets[user_id], offset, start, end)) for user_id in candidates)
+        result = heapq.nsmallest(count, (item for item in scored if item[1] > 0), key=lambda item: (-item[1], item[0]))
+        if len(self.top_cache) >= 64:
+            self.top_cache.clear()
+        self.top_cache[key] = (self.version, result)
+        return result
+
+    def merge(self, other):
+        """other（読み込んだ記録）を加える（空ならそのまま引き継ぐ）"""
+        if not self.buckets:
+            self.buckets = other.buckets
+            self.active = other.active
+            self.version += 1
+            return
+        days = self.DAYS
+        for user_id, buffer in other.buckets.items():
+            for d in range(buffer[0] - days + 1, buffer[0] + 1):
+                points, messages = buffer[1 + d % days], buffer[1 + days + d % days]
+                if points or messages:
+                    self.record(user_id, d, points, messages)
+
+    def load(self, path):
+        """ファイルから読み込む（I/Oスレッドで実行）"""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        magic, version, days, count = ACTIVITY_HEADER.unpack_from(data)
+        if magic != ACTIVITY_MAGIC or version != ACTIVITY_VERSION or days != self.DAYS:
+            logging.error(f"期間別ランキングの記録の形式が違うため読み込みません: {path}")
+            return
+        size = 4 * (1 + 2 * days)
+        offset = ACTIVITY_HEADER.size
+        active = {}
+        for _ in range(count):
+            (user_id,) = ACTIVITY_USER_ID.unpack_from(data, offset)
+            offset += ACTIVITY_USER_ID.size
+            buffer = array("i")
+            buffer.frombytes(data[offset:offset + size])
+            offset += size
+            if sys.byteorder != "little":
+                buffer.byteswap()
+            self.buckets[user_id] = buffer
+            for d in range(buffer[0] - days + 1, buffer[0] + 1):
+                if buffer[1 + d % days] or buffer[1 + days + d % days]:
+                    active.setdefault(d, set()).add(user_id)
+        # 新しい日から DAYS 日分だけを位置に並べ、それより前にしか活動のないユーザーは捨てる
+        kept = sorted(active)[-days:]
+        for d in kept:
+            self.active[d % days] = (d, active[d])
+        oldest = kept[0] if kept else 0
+        for user_id in [user_id for user_id, buffer in self.buckets.items() if buffer[0] < oldest]:
+            del self.buckets[user_id]
+
+    def take_snapshot(self):
+        """保存する内容を取り出す（変更がなければ None）"""
+        if not self.changed:
+            return None
+        self.changed = False
+        parts = [ACTIVITY_HEADER.pack(ACTIVITY_MAGIC, ACTIVITY_VERSION, self.DAYS, len(self.buckets))]
+        for user_id, buffer in self.buckets.items():
+            parts.append(ACTIVITY_USER_ID.pack(user_id))
+            if sys.byteorder != "little":
+                buffer = buffer[:]
+                buffer.byteswap()
+            parts.append(buffer.tobytes())
+        return b"".join(parts)
+
+activity_log = ActivityLog(exclude=ADMIN_USER_IDS)
+
+TOKYO = timezone("Asia/Tokyo")
+
+class DayClock:
+    """タイムゾーンごとの今日の日付（序数）を返す。次の0時を time.monotonic() の時刻で持っておき、
+    普段は数値の比較1回で済ませる。スケジューラが遅れても、0時を過ぎた最初の呼び出しで日付が進む"""
+
+    RECHECK_SECONDS = 3600  # 壁時計とのずれを直すため、最低でもこの間隔で日付を計算し直す
+
+    def __init__(self, tz):
+        self.tz = tz
+        self.day = 0
+        self.boundary = 0.0
+
+    def refresh(self):
+        now = datetime.datetime.now(self.tz)
+        today = now.date()
+        next_midnight = self.tz.localize(datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time()))
+        self.day = today.toordinal()
+        self.boundary = time.monotonic() + min((next_midnight - now).total_seconds(), self.RECHECK_SECONDS)
+        return self.day
+
+    def today(self):
+        if time.monotonic() >= self.boundary:
+            return self.refresh()
+        return self.day
+
+# サーバー（ギルド）ごとのタイムゾーン。例: GUILD_TIMEZONES='{"123456789012345678": "America/New_York"}'
+GUILD_TIMEZONES = json.loads(os.getenv("GUILD_TIMEZONES", "{}"))
+
+default_clock = DayClock(TOKYO)
+clocks_by_zone = {"Asia/Tokyo": default_clock}
+guild_clocks = {int(guild_id): clocks_by_zone.setdefault(zone, DayClock(timezone(zone))) for guild_id, zone in GUILD_TIMEZONES.items()}
+
+def clock_for(guild_id):
+    """サーバーの暦の時計を返す（DMや設定のないサーバーは東京）"""
+    return guild_clocks.get(guild_id, default_clock)
+
+
+# 未保存の変更件数と保存の統計（チューニング用）
+dirty_count = 0
+last_flush_time = time.monotonic()  # 最後に保存できた時刻（起動時は読み込んだ時点で最新）
+state_loaded = False  # データを読み込み終えたか
+persist_stats = {
+    "flushes": 0,  # 実際に行った書き込み回数
+    "coalesced_writes": 0,  # まとめられて省略された書き込み回数
+    "last_flush_ms": 0.0,
+    "max_flush_ms": 0.0,
+    "total_flush_ms": 0.0,
+}
+
+# バイナリスナップショットの形式（リトルエンディアン）
+SNAPSHOT_MAGIC = b"WKPT"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHHQQ")  # マジック, バージョン, 予約, 取り込み済み差分ファイル番号, 件数
+SNAPSHOT_RECORD = struct.Struct("<Qqii")  # UserStore.COLUMNS の順
+
+# ディスクI/O専用のスレッド（書き込みは常にこの1本で順番に行う）
+io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage-io")
+flush_task = None  # 実行中の書き込みタスク（同時に1つまで）
+storage_closed = False  # 終了時に保存先を閉じた後は書き込みを始めない
+
+# イベントループの停止時間（ラグ）の統計
+LOOP_LAG_INTERVAL = 0.5
+loop_lag_stats = {"samples": 0, "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0}
+lag_monitor_task = None
+
+def fsync_dir(path):
+    """リネームを確定させるためにディレクトリを fsync（対応していない環境では何もしない）"""
     try:
-        with open(DATA_FILE, "r") as f:
-            data = json.load(f)
-            user_points.update(data.get("user_points", {}))
-            last_login_date.update({int(k): datetime.datetime.fromisoformat(v).date() for k, v in data.get("last_login_date", {}).items()})
-            login_streaks.update(data.get("login_streaks", {}))
-            monthly_message_count.update(data.get("monthly_message_count", {}))
-        logging.info("データが読み込まれました: %s", data)
-    except FileNotFoundError:
-        logging.info("データファイルが見つかりません。新しいファイルを作成します。")
-    except json.JSONDecodeError:
-        logging.error("データファイルの読み込みに失敗しました。JSON形式に問題があります。")
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def atomic_write(path, data):
+    """一時ファイルに書いて fsync してから置き換える（途中で落ちても元のファイルは壊れない）"""
+    tmp_file = path + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+    fsync_dir(path)
+
+def read_json_state(path):
+    """JSON形式のデータを読み込む"""
+    with open(path, "r") as f:
+        data = json.load(f)
+    store = UserStore()
+    for k, v in data.get("user_points", {}).items():
+        store.points[store.slot(int(k))] = v
+    for k, v in data.get("last_login_date", {}).items():
+        if v != "None":
+            store.last_login[store.slot(int(k))] = datetime.date.fromisoformat(v).toordinal()
+    for k, v in data.get("login_streaks", {}).items():
+        store.streaks[store.slot(int(k))] = v
+    # 旧形式の monthly_message_count は日付の情報がないため引き継がない（メッセージ数は ActivityLog が持つ）
+    return store
+
+def write_json_state(path, store):
+    """データをJSON形式で書き出す"""
+    fromordinal = datetime.date.fromordinal
+    rows = list(store.rows())
+    atomic_write(path, json.dumps({
+        "user_points": {str(row[0]): row[1] for row in rows},
+        "last_login_date": {str(row[0]): fromordinal(row[3]).isoformat() for row in rows if row[3]},
+        "login_streaks": {str(row[0]): row[2] for row in rows if row[2]}
+    }).encode())
+
+def write_binary_snapshot(path, store, seq):
+    """固定長レコードのバイナリ形式でスナップショットを書く"""
+    buf = bytearray(SNAPSHOT_HEADER.size + SNAPSHOT_RECORD.size * len(store))
+    SNAPSHOT_HEADER.pack_into(buf, 0, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, seq, len(store))
+    offset = SNAPSHOT_HEADER.size
+    for row in store.rows():
+        SNAPSHOT_RECORD.pack_into(buf, offset, *row)
+        offset += SNAPSHOT_RECORD.size
+    atomic_write(path, buf)
+    return len(buf)
+
+def read_binary_snapshot(path):
+    """バイナリ形式のスナップショットをメモリマップして1回の走査で読み込み、(データ, 取り込み済み差分ファイル番号) を返す"""
+    store = UserStore()
+    index = store.index
+    columns = store.columns()
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, version, _, seq, count = SNAPSHOT_HEADER.unpack_from(mm, 0)
+        end = SNAPSHOT_HEADER.size + SNAPSHOT_RECORD.size * count
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or len(mm) < end:
+            raise ValueError(f"スナップショットの形式が正しくありません: {path}")
+        appends = [column.append for column in columns]
+        with memoryview(mm) as view:
+            for i, row in enumerate(SNAPSHOT_RECORD.iter_unpack(view[SNAPSHOT_HEADER.size:end])):
+                index[row[0]] = i
+                for append, value in zip(appends, row):
+                    append(value)
+    return store, seq
+
+class SnapshotStorage:
+    """バイナリのベーススナップショット（user_data.bin）と、変更されたユーザーだけを書く差分ファイルによる保存"""
+
+    def __init__(self, snapshot_file, delta_file):
+        self.snapshot_file = snapshot_file
+        self.delta_file = delta_file  # 差分レコードの追記先（番号付きで分割）
+        self.seq = 0  # 現在追記中の差分ファイル番号
+        self.records = 0  # 前回のベーススナップショット以降に書いた差分レコード数
+        self.snapshot_seq = 0  # ベーススナップショットに取り込み済みの差分ファイル番号（これ未満は不要）
+        self.compacting = False
+
+    def delta_path(self, seq):
+        return f"{self.delta_file}.{seq}"
+
+    def list_delta_seqs(self):
+        prefix = os.path.basename(self.delta_file) + "."
+        seqs = []
+        for name in os.listdir(os.path.dirname(self.delta_file) or "."):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                seqs.append(int(name[len(prefix):]))
+        return sorted(seqs)
+
+    def take_batch(self):
+        """変更されたユーザーの行を取り出す（以降の変更は次回の書き込みに回る）"""
+        rows = user_store.take_changed_rows()
+        self.records += len(rows)
+        return (self.seq, rows)
+
+    def requeue(self, batch):
+        user_store.mark_changed(batch[1])
+
+    def write_batch(self, batch):
+        """変更されたユーザーの行を差分ファイルに追記して fsync し、(行数, バイト数) を返す（I/Oスレッドで実行）"""
+        seq, rows = batch
+        if not rows:
+            return 0, 0
+        buf = bytearray(SNAPSHOT_RECORD.size * len(rows))
+        for offset, row in zip(range(0, len(buf), SNAPSHOT_RECORD.size), rows):
+            SNAPSHOT_RECORD.pack_into(buf, offset, *row)
+        with open(self.delta_path(seq), "ab") as f:
+            f.write(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        return len(rows), len(buf)
+
+    def read_state(self):
+        """ベーススナップショットを読み込み、その後の差分を順に適用して状態を復元（I/Oスレッドで実行）"""
+        state = UserStore()
+        try:
+            if os.path.exists(self.snapshot_file):
+                state, self.snapshot_seq = read_binary_snapshot(self.snapshot_file)
+            else:
+                # バイナリ形式になる前の user_data.json から引き継ぐ
+                state = read_json_state(DATA_FILE)
+            logging.info(f"スナップショットを読み込みました: {len(state)} 人分")
+        except FileNotFoundError:
+            logging.info("データファイルが見つかりません。新しいファイルを作成します。")
+        except json.JSONDecodeError:
+            logging.error("データファイルの読み込みに失敗しました。JSON形式に問題があります。")
+        except ValueError as e:
+            logging.error(f"データファイルの読み込みに失敗しました: {e}")
+
+        # 差分ファイルはベーススナップショットと同じ形式で書かれている
+        applied = 0
+        self.seq = self.snapshot_seq
+        for seq in self.list_delta_seqs():
+            if seq < self.snapshot_seq:
+                continue
+            with open(self.delta_path(seq), "rb") as f:
+                data = f.read()
+            usable = len(data) - len(data) % SNAPSHOT_RECORD.size
+            if usable != len(data):
+                # 書き込み途中で停止した最後のレコードは読み飛ばす
+                logging.warning(f"差分ファイルの壊れた末尾を読み飛ばしました: {self.delta_path(seq)}")
+            for row in SNAPSHOT_RECORD.iter_unpack(memoryview(data)[:usable]):
+                state.set_user(*row)
+                applied += 1
+            self.seq = seq
+        state.dirty.clear()
+        self.records = applied
+        logging.info(f"差分を {applied} 件適用しました")
+        return state
+
+    def write_snapshot(self, batch, store, seq):
+        """残りの差分を書いた後でベーススナップショットを作り、取り込み済みの差分ファイルを削除（I/Oスレッドで実行）"""
+        self.write_batch(batch)
+        written = write_binary_snapshot(self.snapshot_file, store, seq)
+        for old_seq in self.list_delta_seqs():
+            if old_seq < seq:
+                os.remove(self.delta_path(old_seq))
+        return written
+
+    def import_state(self, state):
+        """全データでベーススナップショットを作り直し、それまでの差分を破棄する"""
+        self.seq = max(self.list_delta_seqs() + [self.seq]) + 1
+        self.write_snapshot((self.seq, ()), state, self.seq)
+        self.snapshot_seq = self.seq
+        self.records = 0
+
+    async def compact(self):
+        """差分をベーススナップショットにまとめる（ゲートウェイのループはブロックしない）"""
+        if self.compacting or self.records == 0 and not user_store.dirty:
+            return
+        self.compacting = True
+        try:
+            # 書き込み待ちの行を旧番号のまま取り出し、新しい番号に切り替えてその時点の状態を写し取る
+            records = self.records
+            batch = self.take_batch()
+            self.seq += 1
+            self.records = 0
+            snapshot = user_store.copy()
+            started = time.perf_counter()
+            written = await asyncio.get_running_loop().run_in_executor(io_executor, self.write_snapshot, batch, snapshot, self.seq)
+            self.snapshot_seq = self.seq
+            logging.info(f"スナップショットを作成しました（{len(snapshot)} 人分, {written} バイト, {(time.perf_counter() - started) * 1000:.1f} ms）")
+        except OSError as e:
+            logging.error(f"スナップショットの作成に失敗しました: {e}")
+            # 取り出した行は書けたかどうか分からないので、次の保存で新しい番号の差分ファイルに書き直す
+            self.records = records
+            self.requeue(batch)
+            mark_dirty(len(batch[1]))
+        finally:
+            self.compacting = False
+
+    def close(self):
+        pass
+
+# UserStore.COLUMNS の順に並べたテーブルの列
+SQLITE_COLUMNS = "user_id, points, login_streak, last_login_day"
+
+class SqliteStorage:
+    """SQLite（WALモード）による保存。変更されたユーザーの行だけを1トランザクションで書き込む"""
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = None  # I/Oスレッドでのみ使う
+
+    def connect(self):
+        self.conn = sqlite3.connect(self.db_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY,
+                points INTEGER NOT NULL DEFAULT 0,
+                last_login_day INTEGER NOT NULL DEFAULT 0,
+                login_streak INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS users_points ON users (points DESC);
+        """)
+
+    def take_batch(self):
+        """変更されたユーザーの行を変更不可の形で取り出す"""
+        return user_store.take_changed_rows()
+
+    def requeue(self, batch):
+        user_store.mark_changed(batch)
+
+    def write_batch(self, batch):
+        """1行ずつの upsert を1トランザクションで書き込み、(行数, None) を返す（I/Oスレッドで実行）。
+        実際に書いたバイト数はページやWALの書き方で決まり分からないので None"""
+        if not batch:
+            return 0, None
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT INTO users ({SQLITE_COLUMNS}) VALUES ({', '.join('?' * len(UserStore.COLUMNS))}) "
+                "ON CONFLICT (user_id) DO UPDATE SET points = excluded.points, login_streak = excluded.login_streak, "
+                "last_login_day = excluded.last_login_day",
+                batch
+            )
+        return len(batch), None
+
+    def read_state(self):
+        """データベースから読み込む。空ならファイル形式のデータから取り込む（I/Oスレッドで実行）"""
+        self.connect()
+        rows = self.conn.execute(f"SELECT {SQLITE_COLUMNS} FROM users").fetchall()
+        if not rows and (os.path.exists(SNAPSHOT_FILE) or os.path.exists(DATA_FILE)):
+            state = SnapshotStorage(SNAPSHOT_FILE, DELTA_FILE).read_state()
+            self.import_state(state)
+            logging.info(f"ファイル形式のデータから {len(state)} 人分を取り込みました")
+            return state
+        state = UserStore()
+        for row in rows:
+            state.set_user(*row)
+        state.dirty.clear()
+        logging.info(f"データベースを読み込みました: {len(rows)} 人分")
+        return state
+
+    def import_state(self, state):
+        """全データでデータベースの内容を置き換える"""
+        with self.conn:
+            self.conn.execute("DELETE FROM users")
+        self.write_batch(tuple(state.rows()))
+
+    async def compact(self):
+        # WALのチェックポイントはSQLiteが自動で行う
+        pass
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+if STORAGE_BACKEND == "sqlite":
+    storage = SqliteStorage(DB_FILE)
+else:
+    storage = SnapshotStorage(SNAPSHOT_FILE, DELTA_FILE)
+
+def mark_dirty(count=1):
+    """データの変更を記録し、変更件数がしきい値に達したら保存を始める"""
+    global dirty_count
+    dirty_count += count
+    if dirty_count >= SAVE_DIRTY_THRESHOLD:
+        flush_data()
+
+def flush_data():
+    """未保存の変更があれば書き込みを始める（書き込み中なら終わった後にまとめて書く）"""
+    global flush_task
+    if storage_closed or dirty_count == 0 or (flush_task is not None and not flush_task.done()):
+        return flush_task
+    flush_task = asyncio.get_running_loop().create_task(save_data())
+    return flush_task
+
+async def save_data():
+    """溜まった変更をI/Oスレッドで書き込む。書き込み中に増えた変更も続けて書く"""
+    global dirty_count, last_flush_time
+    loop = asyncio.get_running_loop()
+    while dirty_count:
+        count = dirty_count
+        dirty_count = 0
+        batch = storage.take_batch()
+        started = time.perf_counter()
+        try:
+            rows, written = await loop.run_in_executor(io_executor, storage.write_batch, batch)
+        except (OSError, sqlite3.Error) as e:
+            logging.error(f"データの保存に失敗しました: {e}")
+            save_failures.inc()
+            storage.requeue(batch)
+            dirty_count += count
+            return False
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        persist_stats["flushes"] += 1
+        persist_stats["coalesced_writes"] += count - 1
+        persist_stats["last_flush_ms"] = elapsed_ms
+        persist_stats["max_flush_ms"] = max(persist_stats["max_flush_ms"], elapsed_ms)
+        persist_stats["total_flush_ms"] += elapsed_ms
+        save_seconds.observe(elapsed_ms / 1000)
+        save_rows.inc(rows)
+        if written is not None:
+            save_bytes.inc(written)
+        last_flush_time = time.monotonic()
+        size = f", {written} バイト" if written is not None else ""
+        logging.info(f"データを保存しました（変更 {count} 件, {rows} 行{size}, {elapsed_ms:.1f} ms）統計: {persist_stats} ループ停止: {loop_lag_stats} 加算: {accrual_stats} 重複: {event_dedupe.stats} 上限超過: {shed_stats()} DM: {dm_stats} 送り先の検索: {user_lookup_stats}")
+    return True
+
+async def flush_now():
+    """未保存の変更をすべて書き終えるまで待つ（書き込みに失敗した場合はそこで諦める）"""
+    while dirty_count or (flush_task is not None and not flush_task.done()):
+        if not await flush_data():
+            break
+
+async def periodic_flush():
+    flush_data()
+    await save_name_cache()
+
+async def compact_data():
+    flush_data()
+    await storage.compact()
+    await save_activity_log()
+
+async def save_activity_log():
+    """期間別ランキングの記録を保存する（変更があるときだけ。間隔は COMPACT_INTERVAL_SECONDS）"""
+    data = activity_log.take_snapshot()
+    if data is None:
+        return
+    try:
+        await asyncio.get_running_loop().run_in_executor(io_executor, atomic_write, ACTIVITY_FILE, data)
+    except OSError as e:
+        logging.error(f"期間別ランキングの記録の保存に失敗しました: {e}")
+        activity_log.changed = True
+
+def read_activity_log():
+    state = ActivityLog(exclude=ADMIN_USER_IDS)
+    state.load(ACTIVITY_FILE)
+    return state
+
+def read_state_with_leaderboard():
+    """データを読み込み、ランキングも作っておく（I/Oスレッドで実行）"""
+    state = storage.read_state()
+    state.leaderboard = Leaderboard(exclude=ADMIN_USER_IDS)
+    state.rebuild_leaderboard()
+    return state
+
+async def load_data():
+    """ポイントとデータをI/Oスレッドで読み込み、メモリ上のデータに反映"""
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    state = await loop.run_in_executor(io_executor, read_state_with_leaderboard)
+    user_store.merge(state)
+    activity_log.merge(await loop.run_in_executor(io_executor, read_activity_log))
+    await loop.run_in_executor(io_executor, name_cache.load)
+    load_seconds.observe(time.perf_counter() - started)
+
+async def close_storage():
+    """未保存の変更を書き終えてから保存先を閉じる"""
+    global storage_closed
+    await flush_now()
+    await save_activity_log()
+    await save_name_cache()
+    storage_closed = True
+    await asyncio.get_running_loop().run_in_executor(io_executor, storage.close)
+    io_executor.shutdown(wait=True)
+
+# DM 送信の統計（チューニング用）
+dm_stats = {
+    "queued": 0,  # キューに入れたユーザー数
+    "coalesced": 0,  # 送信待ちの DM にまとめた件数
+    "dropped": 0,  # キューがいっぱいで捨てた件数
+    "skipped_closed": 0,  # DM を受け取れないユーザーなので送らなかった件数
+    "closed_users": 0,  # DM を受け取れないと覚えているユーザー数
+    "sent": 0,
+    "failed": 0,
+    "depth": 0,  # 現在の送信待ちユーザー数
+    "max_depth": 0,
+    "last_latency_ms": 0.0,  # キューに入れてから送り終わるまでの時間
+    "max_latency_ms": 0.0,
+    "total_latency_ms": 0.0,
+}
+
+# DM の送り先をどこから得たか（チャンネルのキャッシュ → イベントのユーザー → クライアントのキャッシュ → LRU → REST の順に探す）
+user_lookup_stats = {"channel_cache": 0, "event": 0, "client_cache": 0, "lru": 0, "rest": 0}
+
+class DmDispatcher:
+    """DM を裏で送るキュー。ユーザーごとに送信待ちの通知をまとめ、1通にして送る。
+    DM チャンネルは覚えておき、2回目からはユーザーの取得とチャンネルの作成を省く"""
+
+    def __init__(self, queue_size, workers, channel_cache_size, user_cache_size, closed_cache_size):
+        self.queue = asyncio.Queue(queue_size)  # 送信待ちのユーザーID
+        self.pending = {}  # user_id -> [通知の一覧, ポイントを添えるか, キューに入れた時刻, イベントのユーザー]
+        self.channels = collections.OrderedDict()  # user_id -> DMChannel（古いものから捨てる）
+        self.channel_cache_size = channel_cache_size
+        self.users = collections.OrderedDict()  # user_id -> discord.User / discord.Member（古いものから捨てる）
+        self.user_cache_size = user_cache_size
+        self.closed = {}  # DM を受け取れないユーザーID -> (次に送ってみる時刻 monotonic, 待つ秒数)
+        self.closed_cache_size = closed_cache_size
+        self.worker_count = workers
+        self.workers = []
+
+    def send(self, user_id, text, with_points=False, user=None):
+        """通知を送信待ちに入れる（待たない）。with_points なら送るときの現在のポイントを添える。
+        user にイベントで受け取ったユーザー（payload.member など）を渡すと、送るときに REST で取得しなくて済む"""
+        closed = self.closed.get(user_id)
+        if closed is not None and time.monotonic() < closed[0]:
+            dm_stats["skipped_closed"] += 1
+            return False
+        entry = self.pending.get(user_id)
+        if entry is not None:
+            entry[0].append(text)
+            entry[1] = entry[1] or with_points
+            entry[3] = entry[3] or user
+            dm_stats["coalesced"] += 1
+            return True
+        try:
+            self.queue.put_nowait(user_id)
+        except asyncio.QueueFull:
+            dm_stats["dropped"] += 1
+            logging.warning(f"DM の送信待ちがいっぱいのため通知を捨てました: {user_id}")
+            return False
+        self.pending[user_id] = [[text], with_points, time.perf_counter(), user]
+        dm_stats["queued"] += 1
+        dm_stats["depth"] = self.queue.qsize()
+        dm_stats["max_depth"] = max(dm_stats["max_depth"], dm_stats["depth"])
+        return True
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self.worker()) for _ in range(self.worker_count)]
+
+    async def close(self):
+        """送信待ちを送り切る（DM_DRAIN_TIMEOUT まで）。残りは捨てる"""
+        if not self.workers:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), DM_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(f"送信できなかった DM が {self.queue.qsize()} 件あります")
+        for task in self.workers:
+            task.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def worker(self):
+        while True:
+            user_id = await self.queue.get()
+            try:
+                texts, with_points, queued_at, user = self.pending.pop(user_id)
+                dm_stats["depth"] = self.queue.qsize()
+                content = "\n".join(texts)
+                if with_points:
+                    content += f' 現在のポイント: {user_store.get_points(user_id)} 🪙'
+                await self.deliver(user_id, content, user)
+                if self.closed.pop(user_id, None) is not None:
+                    dm_stats["closed_users"] = len(self.closed)
+                latency_ms = (time.perf_counter() - queued_at) * 1000
+                dm_stats["sent"] += 1
+                dm_stats["last_latency_ms"] = latency_ms
+                dm_stats["max_latency_ms"] = max(dm_stats["max_latency_ms"], latency_ms)
+                dm_stats["total_latency_ms"] += latency_ms
+                dm_sent.inc()
+                dm_latency_seconds.observe(latency_ms / 1000)
+            except discord.Forbidden:
+                dm_stats["failed"] += 1
+                dm_failed.inc()
+                self.mark_closed(user_id)
+            except discord.HTTPException as e:
+                dm_stats["failed"] += 1
+                dm_failed.inc()
+                logging.warning(f"DM を送れませんでした: {user_id} {e}")
+            except Exception:
+                dm_stats["failed"] += 1
+                dm_failed.inc()
+                logging.exception(f"DM の送信中にエラーが発生しました: {user_id}")
+            finally:
+                self.queue.task_done()
+
+    def mark_closed(self, user_id):
+        """DM を受け取れないユーザーを覚える。期限が過ぎたら次の通知で送ってみて、また失敗したら間隔を倍にする"""
+        previous = self.closed.get(user_id)
+        ttl = DM_CLOSED_TTL_SECONDS if previous is None else min(previous[1] * 2, DM_CLOSED_MAX_TTL_SECONDS)
+        now = time.monotonic()
+        if user_id not in self.closed and len(self.closed) >= self.closed_cache_size:
+            # 期限が過ぎたまま送っていないユーザーを捨てる。それでもいっぱいなら一番早く期限が来るユーザーを捨てる
+            self.closed = {k: v for k, v in self.closed.items() if v[0] + v[1] > now}
+            if len(self.closed) >= self.closed_cache_size:
+                del self.closed[min(self.closed, key=lambda k: self.closed[k][0])]
+        self.closed[user_id] = (now + ttl, ttl)
+        dm_stats["closed_users"] = len(self.closed)
+        logging.info(f"DM を受け取れないユーザーです。{ttl / 3600:.0f} 時間は送りません: {user_id}")
+
+    async def lookup_user(self, user_id, user):
+        """送り先のユーザーを探す（REST は最後の手段）"""
+        if user is not None:
+            user_lookup_stats["event"] += 1
+        else:
+            user = bot.get_user(user_id)
+            if user is not None:
+                user_lookup_stats["client_cache"] += 1
+            else:
+                user = self.users.get(user_id)
+                if user is not None:
+                    user_lookup_stats["lru"] += 1
+                else:
+                    user = await bot.fetch_user(user_id)
+                    user_lookup_stats["rest"] += 1
+        self.users[user_id] = user
+        self.users.move_to_end(user_id)
+        if len(self.users) > self.user_cache_size:
+            self.users.popitem(last=False)
+        return user
+
+    async def deliver(self, user_id, content, user=None):
+        channel = self.channels.get(user_id)
+        if channel is None:
+            user = await self.lookup_user(user_id, user)
+            channel = user.dm_channel or await user.create_dm()
+            self.channels[user_id] = channel
+            if len(self.channels) > self.channel_cache_size:
+                self.channels.popitem(last=False)
+        else:
+            user_lookup_stats["channel_cache"] += 1
+            self.channels.move_to_end(user_id)
+        await channel.send(content)
+
+dm_dispatcher = DmDispatcher(DM_QUEUE_SIZE, DM_WORKERS, DM_CHANNEL_CACHE_SIZE, DM_USER_CACHE_SIZE, DM_CLOSED_CACHE_SIZE)
+
+# ポイント加算の統計（チューニング用）
+accrual_stats = {
+    "events": 0,  # 反映したイベント数
+    "batches": 0,  # まとめて反映した回数
+    "users": 0,  # 反映したユーザー数の合計（1回の中で同じユーザーは1人と数える）
+    "inline": 0,  # キューがいっぱいでその場で反映したイベント数
+    "dropped": 0,  # 最後の保存が始まった後に届き、保存できないので捨てたイベント数
+    "max_batch": 0,
+    "depth": 0,  # 最後に見たときの反映待ちのイベント数
+}
+
+class AccrualPipeline:
+    """メッセージ・リアクションによるポイント加算をキューに積み、まとめて反映する。
+    1回分の中ではユーザーごとに加算をまとめ、ログインボーナスの確認も変更の記録もユーザーにつき1回で済ませる"""
+
+    def __init__(self, queue_size, batch_size, interval):
+        self.queue = asyncio.Queue(queue_size)  # (ユーザーID, 日の序数, ポイント, メッセージ数, イベントのユーザー)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.task = None
+        self.closing = False  # 終了処理が始まったら積まずにその場で反映する
+        self.stopped = False  # 最後の保存が始まったら受け付けない
+
+    def push(self, user_id, day, points, messages=0, user=None):
+        """加算を積む（待たない）。キューがいっぱいか終了処理中ならその場で反映する"""
+        if self.stopped:
+            accrual_stats["dropped"] += 1
+            return
+        event = (user_id, day, points, messages, user)
+        if self.closing:
+            self.apply([event])
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            accrual_stats["inline"] += 1
+            self.apply([event])
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.consume())
+
+    async def close(self):
+        """残っている加算をすべて反映してから止める（以降に届いた加算はその場で反映される）"""
+        self.closing = True
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch:
+            self.apply(batch)
+
+    async def consume(self):
+        queue = self.queue
+        while True:
+            batch = [await queue.get()]
+            # 待たずに取り出せる分だけまとめる（静かなときは最初のイベントがすぐに反映される）
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            accrual_stats["depth"] = queue.qsize()
+            try:
+                self.apply(batch)
+            except Exception:
+                logging.exception("ポイントの加算中にエラーが発生しました")
+            if len(batch) > 1:
+                # 混んでいるときは少し待ち、その間のイベントを次の1回にまとめる
+                await asyncio.sleep(self.interval)
+
+    def apply(self, batch):
+        totals = {}  # (ユーザーID, 日の序数) -> [ポイント, メッセージ数, イベントのユーザー]
+        for user_id, day, points, messages, user in batch:
+            entry = totals.get((user_id, day))
+            if entry is None:
+                totals[(user_id, day)] = [points, messages, user]
+            else:
+                entry[0] += points
+                entry[1] += messages
+                entry[2] = entry[2] or user
+        for (user_id, day), (points, messages, user) in totals.items():
+            user_store.add_points(user_id, points)
+            activity_log.record(user_id, day, points=points, messages=messages)
+            # ログインの記録はサーバーの暦によらず東京の日付で数える（暦が混ざると連続日数が狂う）
+            bonus_message = check_and_give_login_bonus(user_id, default_clock.today())
+            if bonus_message:
+                dm_dispatcher.send(user_id, bonus_message, with_points=True, user=user)
+        mark_dirty(len(totals))  # 変更を記録（保存はまとめて行う）
+        accrual_stats["events"] += len(batch)
+        accrual_stats["batches"] += 1
+        accrual_stats["users"] += len(totals)
+        accrual_stats["max_batch"] = max(accrual_stats["max_batch"], len(batch))
+
+accrual_pipeline = AccrualPipeline(ACCRUAL_QUEUE_SIZE, ACCRUAL_BATCH_SIZE, ACCRUAL_INTERVAL)
+
+class DedupeWindow:
+    """直近 capacity 件のイベントのキーを覚え、同じイベントが再び届いたら見分ける。
+    キーはリングバッファ（古い順）と集合の両方に入れ、いっぱいになったら一番古いキーから忘れる（メモリは一定）"""
+
+    def __init__(self, capacity):
+        self.capacity = max(capacity, 0)  # 0なら何も覚えない
+        self.ring = array("q", bytes(8 * self.capacity))
+        self.position = 0
+        self.keys = set()
+        self.stats = {"checked": 0, "duplicates": 0}
+
+    def seen(self, key):
+        """key がすでに届いていれば True。初めてなら覚えて False"""
+        self.stats["checked"] += 1
+        if self.capacity == 0:
+            return False
+        if key in self.keys:
+            self.stats["duplicates"] += 1
+            return True
+        if len(self.keys) >= self.capacity:
+            self.keys.discard(self.ring[self.position])
+        self.ring[self.position] = key
+        self.position = (self.position + 1) % self.capacity
+        self.keys.add(key)
+        return False
+
+class TokenBuckets:
+    """キー（ユーザーIDやチャンネルID）ごとのトークンバケット。トークンと最後に補充した時刻を型付き配列で持ち、
+    補充は次に使うときに経過時間からまとめて計算する（タイマーも全員分の走査もしない）"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate  # 1秒あたりに回復するトークン
+        self.burst = burst  # トークンの最大量
+        self.index = {}  # キー -> 連番
+        self.tokens = array("d")
+        self.updated = array("d")  # 最後に補充した時刻（time.monotonic()）
+        self.shed = 0  # 上限を超えて捨てたイベント数
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def allow(self, key, now):
+        """トークンを1つ使えれば True。足りなければ捨てた数を数えて False"""
+        if self.rate <= 0:
+            return True
+        i = self.index.get(key)
+        if i is None:
+            i = self.index[key] = len(self.tokens)
+            self.tokens.append(self.burst)
+            self.updated.append(now)
+        tokens = min(self.burst, self.tokens[i] + (now - self.updated[i]) * self.rate)
+        self.updated[i] = now
+        if tokens < 1:
+            self.tokens[i] = tokens
+            self.shed += 1
+            return False
+        self.tokens[i] = tokens - 1
+        return True
+
+message_limits = TokenBuckets(MESSAGE_RATE, MESSAGE_BURST)
+reaction_limits = TokenBuckets(REACTION_RATE, REACTION_BURST)
+channel_limits = TokenBuckets(CHANNEL_RATE, CHANNEL_BURST)
+
+def accrual_allowed(user_limits, user_id, channel_id):
+    """ユーザーとチャンネルの上限の範囲ならポイントを付ける（ユーザーで捨てたものはチャンネルのトークンを使わない）"""
+    now = time.monotonic()
+    return user_limits.allow(user_id, now) and channel_limits.allow(channel_id, now)
+
+def shed_stats():
+    return {"messages": message_limits.shed, "reactions": reaction_limits.shed, "channels": channel_limits.shed}
+
+# 再接続後の再送などで同じメッセージ・リアクションが2回届いてもポイントを2回付けない
+event_dedupe = DedupeWindow(DEDUPE_WINDOW)
+
+def reaction_key(payload):
+    """リアクションのキー（メッセージ, ユーザー, 絵文字）を64ビットの整数にまとめる"""
+    emoji = payload.emoji
+    return hash((payload.message_id, payload.user_id, emoji.id or emoji.name))
+
+async def monitor_loop_lag():
+    """イベントループが止まっていた時間を計測する"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag_ms = max(0.0, (loop.time() - started - LOOP_LAG_INTERVAL) * 1000)
+        loop_lag_stats["samples"] += 1
+        loop_lag_stats["last_ms"] = lag_ms
+        loop_lag_stats["max_ms"] = max(loop_lag_stats["max_ms"], lag_ms)
+        loop_lag_stats["total_ms"] += lag_ms
+        loop_lag_seconds.observe(lag_ms / 1000)
 
 @bot.event
 async def on_ready():
+    # 再接続のたびに呼ばれることがあるので、ここでは初期化しない（setup_hook を参照）
+    global gateway_connected
+    gateway_connected = True
     logging.info(f'Logged in as {bot.user}')
+
+def command_tree_hash(guild=None):
+    """同期されるコマンドの内容（名前・説明・引数など）のハッシュ"""
+    payload = sorted((command.to_dict(bot.tree) for command in bot.tree.get_commands(guild=guild)), key=lambda c: (c["name"], c.get("type", 1)))
+    data = json.dumps([bot.application_id, payload], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+def read_command_sync_state():
+    try:
+        with open(COMMAND_SYNC_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.error(f"コマンドの同期の記録を読み込めませんでした: {e}")
+        return {}
+
+async def sync_commands():
+    """コマンドの内容が前回の同期から変わっていれば同期する"""
+    guild = discord.Object(id=int(COMMAND_SYNC_GUILD_ID)) if COMMAND_SYNC_GUILD_ID else None
+    if guild is not None:
+        bot.tree.copy_global_to(guild=guild)
+    scope = f"guild:{guild.id}" if guild else "global"
+    loop = asyncio.get_running_loop()
+    state = await loop.run_in_executor(io_executor, read_command_sync_state)
+    digest = command_tree_hash(guild)
+    if state.get(scope) == digest and not COMMAND_SYNC_FORCE:
+        logging.info(f'コマンドに変更がないため同期を省略しました（{scope}）')
+        return
     try:
-        synced = await bot.tree.sync()
-        logging.info(f'Synced {len(synced)} command(s)')
+        synced = await bot.tree.sync(guild=guild)
+        logging.info(f'Synced {len(synced)} command(s)（{scope}）')
     except Exception as e:
         logging.error(f'Failed to sync commands: {e}')
-    load_data()  # データの読み込み
-    logging.info(f'ポイントデータ: {user_points}')  # 追加: ポイントデータの確認
+        return
+    state[scope] = digest
+    data = json.dumps(state, ensure_ascii=False).encode("utf-8")
+    try:
+        await loop.run_in_executor(io_executor, atomic_write, COMMAND_SYNC_FILE, data)
+    except OSError as e:
+        logging.error(f"コマンドの同期の記録を保存できませんでした: {e}")
+
+async def start_services():
+    """データを読み込み、コマンドを同期し、裏の処理（キュー・定期保存）を始める"""
+    global lag_monitor_task, state_loaded
+    await start_http_server()  # 読み込み中も /healthz には答える
+    started = time.perf_counter()
+    await load_data()  # データの読み込み
+    state_loaded = True
+    logging.info(f'ポイントデータ: {len(user_store)} 人分（{(time.perf_counter() - started) * 1000:.0f} ms）')  # 追加: ポイントデータの確認
+    await sync_commands()
+    await refresh_api_snapshot()
+    lag_monitor_task = asyncio.create_task(monitor_loop_lag())
+    dm_dispatcher.start()
+    accrual_pipeline.start()
     scheduler.start()  # スケジューラの開始
 
+# 読み取り用のHTTP API（/api/...）。応答はすべて作り終えたスナップショットから返し、ボットが更新中のデータには触れない。
+# スナップショットは変更があるときに別スレッドで作り、できたら参照を1回で差し替える
+API_PERIODS = ("daily", "weekly", "monthly")
+API_KINDS = ("points", "messages")
+API_BOOT_ID = secrets.token_hex(4)  # ETag を再起動の前後で区別する
+
+api_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="api-snapshot")
+api_snapshot = None  # 最新のスナップショット（差し替えるだけで中身は変えない）
+api_snapshot_seq = 0
+api_snapshot_source = None  # 最新のスナップショットの元になった (ランキング, version, 期間別の記録の version, 日)
+api_snapshot_task = None
+api_responses = {}  # (スナップショットの番号, パスとクエリ) -> 作った応答の本文（ループ側だけで使う）
+
+class ApiSnapshot:
+    """ある時点のポイント・順位・期間別の集計（作ったあとは変更しない）"""
+
+    __slots__ = ("seq", "etag", "day", "ids", "points", "index", "order", "ranks", "windows", "user_windows")
+
+    def __init__(self, seq, day, ids, points, index):
+        self.seq = seq
+        self.etag = f'"{API_BOOT_ID}-{seq}"'
+        self.day = day
+        self.ids = ids  # 連番 -> ユーザーID
+        self.points = points  # 連番 -> ポイント
+        self.index = index  # ユーザーID -> 連番
+        self.order = array("I")  # 順位の順に並べた連番（管理者は除く）
+        self.ranks = array("I", bytes(4 * len(ids)))  # 連番 -> 順位（0はランキングに載っていない）
+        self.windows = {}  # (期間, 種類) -> 値の大きい順の [(ユーザーID, 値)]
+        self.user_windows = {}  # ユーザーID -> {期間: (獲得ポイント, メッセージ数)}
+
+    def row(self, user_id):
+        return self.index.get(user_id)
+
+def build_api_snapshot(previous, seq, day, ids, points, buckets):
+    """スナップショットを作る（api_executor で実行）。ids・points・buckets はループ側で作ったコピー"""
+    # 連番は増えるだけなので、前回の順位の並びに新しいユーザーを足して並べ直す（ほぼ整列済みなので速い）
+    exclude = ADMIN_USER_IDS
+    previous_count = len(previous.ids) if previous is not None else 0
+    if previous is not None and len(ids) >= previous_count and ids[:previous_count] == previous.ids:
+        # 公開中のスナップショットの辞書は変えず、写したものに新しいユーザーだけ足す
+        index = dict(previous.index)
+        for i in range(previous_count, len(ids)):
+            index[ids[i]] = i
+        order = list(previous.order)
+        order.extend(i for i in range(previous_count, len(ids)) if ids[i] not in exclude)
+    else:
+        index = {user_id: i for i, user_id in enumerate(ids)}
+        order = [i for i in range(len(ids)) if ids[i] not in exclude]
+    snapshot = ApiSnapshot(seq, day, ids, points, index)
+    # (-ポイント, ユーザーID) の順。タプルより比べるのが速い1つの整数にまとめる（ユーザーIDは64ビットに収まる）
+    order.sort(key=lambda i: (-points[i] << 64) + ids[i])
+    snapshot.order = array("I", order)
+    ranks = snapshot.ranks
+    for rank, i in enumerate(order, 1):
+        ranks[i] = rank
+    window_sum = ActivityLog.window_sum
+    days = ActivityLog.DAYS
+    starts = {period: period_start(period, day) for period in API_PERIODS}
+    for user_id, buffer in buckets.items():
+        snapshot.user_windows[user_id] = {
+            period: (window_sum(buffer, 1, start, day), window_sum(buffer, 1 + days, start, day))
+            for period, start in starts.items()
+        }
+    for period in API_PERIODS:
+        for column, kind in enumerate(API_KINDS):
+            values = [(user_id, totals[period][column]) for user_id, totals in snapshot.user_windows.items()
+                      if totals[period][column] > 0 and user_id not in exclude]
+            values.sort(key=lambda item: (-item[1], item[0]))
+            snapshot.windows[(period, kind)] = values
+    return snapshot
+
+async def refresh_api_snapshot():
+    """データが変わっていればスナップショットを作り直して差し替える（同時に1つまで）"""
+    global api_snapshot, api_snapshot_seq, api_snapshot_source, api_snapshot_task
+    if api_snapshot_task is not None and not api_snapshot_task.done():
+        return
+    day = default_clock.today()
+    board = user_store.leaderboard
+    source = (board, board.version, activity_log.version, day)
+    if source == api_snapshot_source:
+        return
+    # ループ側では配列のコピーだけを作る（並べ替えや集計はスレッドで行う）
+    ids = user_store.user_ids[:]
+    points = user_store.points[:]
+    buckets = {user_id: buffer[:] for user_id, buffer in activity_log.buckets.items()}
+    api_snapshot_seq += 1
+    loop = asyncio.get_running_loop()
+    try:
+        api_snapshot_task = loop.run_in_executor(api_executor, build_api_snapshot, api_snapshot, api_snapshot_seq, day, ids, points, buckets)
+        api_snapshot = await api_snapshot_task
+    except Exception:
+        logging.exception("APIのスナップショットを作れませんでした")
+        return
+    api_snapshot_source = source
+    api_responses.clear()  # 古いスナップショットから作った応答はもう使わない
+
+def api_int(value, default, low, high):
+    try:
+        return max(low, min(int(value), high))
+    except (TypeError, ValueError):
+        return default
+
+def api_user_id(request):
+    try:
+        return int(request.match_info["user_id"])
+    except ValueError:
+        raise web.HTTPBadRequest(text="user_id must be an integer")
+
+def api_response(request, build):
+    """スナップショットから JSON の応答を返す。If-None-Match が今の ETag と同じなら 304"""
+    snapshot = api_snapshot
+    if snapshot is None:
+        return web.json_response({"error": "not ready"}, status=503, headers={"Retry-After": "5"})
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if API_CORS_ORIGIN:
+        headers["Access-Control-Allow-Origin"] = API_CORS_ORIGIN
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        if "*" in tags or snapshot.etag in tags:
+            return web.Response(status=304, headers=headers)
+    key = (snapshot.seq, request.path_qs)
+    body = api_responses.get(key)
+    if body is None:
+        body = json.dumps(build(snapshot), ensure_ascii=False).encode("utf-8")
+        if len(api_responses) >= 1024:
+            api_responses.clear()
+        api_responses[key] = body
+    return web.Response(body=body, content_type="application/json", charset="utf-8", headers=headers)
+
+def api_user_entry(snapshot, user_id):
+    i = snapshot.row(user_id)
+    return {
+        "user_id": str(user_id),  # JavaScript の数値では桁が足りないため文字列で返す
+        "points": snapshot.points[i] if i is not None else 0,
+        "rank": (snapshot.ranks[i] or None) if i is not None else None,
+    }
+
+async def handle_api_user(request):
+    user_id = api_user_id(request)
+
+    def build(snapshot):
+        entry = api_user_entry(snapshot, user_id)
+        windows = snapshot.user_windows.get(user_id, {})
+        for period in API_PERIODS:
+            earned, messages = windows.get(period, (0, 0))
+            entry[period] = {"points": earned, "messages": messages}
+        return entry
+
+    return api_response(request, build)
+
+async def handle_api_rank(request):
+    user_id = api_user_id(request)
+    neighbours = api_int(request.query.get("neighbours"), LEADERBOARD_NEIGHBOURS, 0, 10)
+
+    def build(snapshot):
+        entry = api_user_entry(snapshot, user_id)
+        entry["total"] = len(snapshot.order)
+        rank = entry["rank"]
+        if rank is None:
+            entry["neighbours"] = []
+            return entry
+        start = max(0, rank - 1 - neighbours)
+        entry["neighbours"] = [
+            {"rank": position, "user_id": str(snapshot.ids[i]), "points": snapshot.points[i]}
+            for position, i in enumerate(snapshot.order[start:rank + neighbours], start + 1)
+        ]
+        return entry
+
+    return api_response(request, build)
+
+async def handle_api_leaderboard(request):
+    period = request.match_info.get("period", "total")
+    kind = request.query.get("kind", "points")
+    if (period != "total" and period not in API_PERIODS) or kind not in API_KINDS or (period == "total" and kind != "points"):
+        raise web.HTTPNotFound(text="unknown leaderboard")
+    limit = api_int(request.query.get("limit"), 10, 1, API_MAX_LIMIT)
+    offset = api_int(request.query.get("offset"), 0, 0, 2**31)
+
+    def build(snapshot):
+        if period == "total":
+            rows = [(snapshot.ids[i], snapshot.points[i]) for i in snapshot.order[offset:offset + limit]]
+            total = len(snapshot.order)
+        else:
+            values = snapshot.windows[(period, kind)]
+            rows = values[offset:offset + limit]
+            total = len(values)
+        return {
+            "period": period,
+            "kind": kind,
+            "day": datetime.date.fromordinal(snapshot.day).isoformat(),
+            "total": total,
+            "entries": [{"rank": rank, "user_id": str(user_id), "value": value} for rank, (user_id, value) in enumerate(rows, offset + 1)],
+        }
+
+    return api_response(request, build)
+
+http_runner = None
+gateway_connected = False  # ゲートウェイにつながっているか（on_ready / on_resumed / on_disconnect で更新）
+
+def readiness():
+    """(準備できているか, 各項目の結果)"""
+    checks = {
+        "gateway": gateway_connected and not bot.is_closed(),
+        "state_loaded": state_loaded,
+        "flush_recent": dirty_count == 0 or time.monotonic() - last_flush_time <= READY_MAX_FLUSH_AGE,
+    }
+    return all(checks.values()), checks
+
+async def handle_healthz(request):
+    return web.Response(text="ok")
+
+async def handle_readyz(request):
+    ready, checks = readiness()
+    return web.json_response({"ready": ready, "checks": checks}, status=200 if ready else 503)
+
+@bot.event
+async def on_app_command_completion(interaction, command):
+    histogram, _ = metrics_for_command(command.qualified_name)
+    histogram.observe(time.perf_counter() - interaction.extras.get("started", time.perf_counter()))
+
+def render_metrics():
+    lines = []
+    for name, (kind, help_text, metrics) in metric_families.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for metric in metrics:
+            lines.extend(metric.render(name))
+    # これまでの統計の辞書もそのまま値として出す
+    stats = (
+        ("bot_persist", persist_stats), ("bot_loop_lag", loop_lag_stats), ("bot_accrual", accrual_stats),
+        ("bot_dedupe", event_dedupe.stats), ("bot_shed", shed_stats()), ("bot_dm", dm_stats), ("bot_user_lookup", user_lookup_stats),
+    )
+    for prefix, values in stats:
+        for key, value in values.items():
+            lines.append(f"# TYPE {prefix}_{key} gauge")
+            lines.append(f"{prefix}_{key} {value}")
+    lines.append("# TYPE bot_users gauge")
+    lines.append(f"bot_users {len(user_store)}")
+    lines.append("# TYPE bot_dirty_changes gauge")
+    lines.append(f"bot_dirty_changes {dirty_count}")
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics(request):
+    return web.Response(body=render_metrics().encode("utf-8"), headers={"Content-Type": METRICS_CONTENT_TYPE})
+
+async def handle_root(request):
+    return web.Response(text="Server is running")
+
+def create_http_app():
+    app = web.Application()
+    app.router.add_get("/", handle_root)
+    app.router.add_get("/healthz", handle_healthz)
+    app.router.add_get("/readyz", handle_readyz)
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/api/users/{user_id}", handle_api_user)
+    app.router.add_get("/api/users/{user_id}/rank", handle_api_rank)
+    app.router.add_get("/api/leaderboard", handle_api_leaderboard)
+    app.router.add_get("/api/leaderboard/{period}", handle_api_leaderboard)
+    return app
+
+async def start_http_server():
+    global http_runner
+    if http_runner is not None:
+        return
+    runner = web.AppRunner(create_http_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, HTTP_HOST, HTTP_PORT).start()
+    http_runner = runner
+    logging.info(f"HTTPサーバーを開始しました: {HTTP_HOST}:{HTTP_PORT}")
+
+async def stop_http_server():
+    global http_runner
+    if http_runner is not None:
+        await http_runner.cleanup()
+        http_runner = None
+
 @bot.event
 async def on_disconnect():
+    global gateway_connected
+    gateway_connected = False
     logging.warning('Bot has been disconnected')
 
 @bot.event
 async def on_resumed():
+    global gateway_connected
+    gateway_connected = True
     logging.info('Bot has resumed connection')
 
 def check_and_give_login_bonus(user_id, today):
-    last_login = last_login_date[user_id]
+    last_login, streak_days = user_store.get_login(user_id)
     bonus_message = ""
-    if last_login is None or last_login != today:
-        user_points[user_id] += 50
+    if today > last_login:
+        bonus = 50
         bonus_message = "ログインボーナスとして 50 🪙 ポイントを獲得しました！"
-        if last_login is None or (today - last_login).days > 1:
-            login_streaks[user_id] = 1
+        if last_login == 0 or today - last_login > 1:
+            streak_days = 1
         else:
-            login_streaks[user_id] += 1
+            streak_days += 1
 
-        streak_days = login_streaks[user_id]
+        streak = streak_days
         if streak_days == 3:
-            user_points[user_id] += 50
+            bonus += 50
             bonus_message += " さらに、3日連続のログインボーナスとして追加で50ポイントを獲得しました！"
         elif streak_days == 5:
-            user_points[user_id] += 100
+            bonus += 100
             bonus_message += " さらに、5日連続のログインボーナスとして追加で100ポイントを獲得しました！"
         elif streak_days == 10:
-            user_points[user_id] += 200
+            bonus += 200
             bonus_message += " さらに、10日連続のログインボーナスとして追加で200ポイントを獲得しました！"
-            login_streaks[user_id] = 0
+            streak = 0
 
-        last_login_date[user_id] = today
+        user_store.add_points(user_id, bonus)
+        user_store.set_login(user_id, today, streak)
+        activity_log.record(user_id, today, points=bonus)
+        mark_dirty()
         return bonus_message
     return bonus_message
 
-def reset_daily_tasks():
-    global current_date
-    today = datetime.datetime.now(timezone("Asia/Tokyo")).date()
-    logging.info(f"タスク実行 - 現在の日付: {today}, 記録された日付: {current_date}")  # 日付変更確認用のログ
-
-    # 日付が変更された場合
-    if today != current_date:
-        logging.info(f"日付が変更されました。旧日付: {current_date}, 新日付: {today}")  # 日付変更のログ
-        monthly_message_count.clear()
-        current_date = today
-        save_data()
-        logging.info("メッセージ数がリセットされました。")
-    else:
-        logging.info("日付は変更されていません。")
-
 scheduler = AsyncIOScheduler()
-scheduler.add_job(reset_daily_tasks, CronTrigger(hour=0, minute=0, timezone=timezone("Asia/Tokyo")))
+scheduler.add_job(periodic_flush, IntervalTrigger(seconds=SAVE_INTERVAL_SECONDS))
+scheduler.add_job(compact_data, IntervalTrigger(seconds=COMPACT_INTERVAL_SECONDS))
+scheduler.add_job(refresh_api_snapshot, IntervalTrigger(seconds=API_SNAPSHOT_INTERVAL))
 
 @bot.event
+@timed(on_message_seconds)
 async def on_message(message):
     if message.author == bot.user:
         return
 
-    user_id = message.author.id
-    today = current_date
+    if event_dedupe.seen(message.id):
+        return  # 同じメッセージが再び届いた
 
-    # メッセージを投稿するごとにポイントを30追加
-    user_points[user_id] += 30
-    monthly_message_count[user_id] += 1
-    save_data()  # データの保存
+    user_id = message.author.id
+    today = clock_for(message.guild.id if message.guild else None).today()
 
-    bonus_message = check_and_give_login_bonus(user_id, today)
-    if bonus_message:
-        await message.author.send(f'{bonus_message} 現在のポイント: {user_points[user_id]} 🪙')
+    # メッセージを投稿するごとにポイントを30追加（ログインボーナスとあわせてまとめて反映）
+    # 連投は上限を超えた分を捨てる（ポイントも保存も発生しない）
+    if accrual_allowed(message_limits, user_id, message.channel.id):
+        accrual_pipeline.push(user_id, today, 30, messages=1, user=message.author)
 
     # 通常のメッセージ処理
     await bot.process_commands(message)
 
 @bot.event
+@timed(on_reaction_seconds)
 async def on_raw_reaction_add(payload):
-    logging.info(f'リアクション追加イベント: {payload}')
+    logging.debug('リアクション追加イベント: %s', payload)  # 文字列にするのはデバッグ出力が有効なときだけ
     if payload.user_id == bot.user.id:
         return
 
+    if event_dedupe.seen(reaction_key(payload)):
+        return  # 同じリアクションが再び届いた（付け直しも含む）
+
     user_id = payload.user_id
-    today = current_date
+    today = clock_for(payload.guild_id).today()
 
-    # リアクションするごとにポイントを5追加
-    user_points[user_id] += 5
-    save_data()  # データの保存
+    # リアクションするごとにポイントを5追加（ログインボーナスとあわせてまとめて反映）
+    if accrual_allowed(reaction_limits, user_id, payload.channel_id):
+        accrual_pipeline.push(user_id, today, 5, user=payload.member)
 
-    bonus_message = check_and_give_login_bonus(user_id, today)
-    if bonus_message:
-        user = await bot.fetch_user(user_id)
-        await user.send(f'{bonus_message} 現在のポイント: {user_points[user_id]} 🪙')
+def message_counts_text(user_id, guild_id):
+    """今日・今週・今月のメッセージ数を1行にまとめる"""
+    today = clock_for(guild_id).today()
+    counts = [f"{PERIOD_NAMES[period]} {activity_log.totals(user_id, period_start(period, today), today)[1]}"
+              for period in ("daily", "weekly", "monthly")]
+    return "メッセージ数: " + " / ".join(counts)
 
-@bot.tree.command(name="ポイント", description="現在のポイントを表示します")
+@bot.tree.command(name="ポイント", description="現在のポイントと今日・今週・今月のメッセージ数を表示します")
 @app_commands.describe(member="ポイントを確認するメンバー")
 async def points(interaction: discord.Interaction, member: discord.Member = None):
     if member:
         user_id = member.id
-        points = user_points[user_id]
-        await interaction.response.send_message(f'{member.mention} のポイント: {points} 🪙', ephemeral=True)
+        points = user_store.get_points(user_id)
+        await interaction.response.send_message(f'{member.mention} のポイント: {points} 🪙\n{message_counts_text(user_id, interaction.guild_id)}', ephemeral=True)
     else:
         user_id = interaction.user.id
-        points = user_points[user_id]
-        await interaction.response.send_message(f'{interaction.user.mention} あなたのポイント: {points} 🪙', ephemeral=True)
+        points = user_store.get_points(user_id)
+        await interaction.response.send_message(f'{interaction.user.mention} あなたのポイント: {points} 🪙\n{message_counts_text(user_id, interaction.guild_id)}', ephemeral=True)
 
 # ポイント贈答の部分を以下に修正
 @bot.tree.command(name="ポイント贈答", description="他のメンバーにポイントをプレゼントします")
 @app_commands.describe(member="ポイントを贈るメンバー", points="贈答するポイント数")
 async def give_points(interaction: discord.Interaction, member: discord.Member, points: int):
     giver_id = interaction.user.id
-    if giver_id in ADMIN_USER_IDS or user_points[giver_id] >= points:
-        user_points[member.id] += points
+    if giver_id in ADMIN_USER_IDS or user_store.get_points(giver_id) >= points:
+        # 贈答はポイントの移動なので期間の獲得ポイントには数えない（自分宛てや贈り合いで順位を上げられないように）
+        user_store.add_points(member.id, points)
         if giver_id not in ADMIN_USER_IDS:
-            user_points[giver_id] -= points
-        save_data()  # データの保存
-        await interaction.response.send_message(f'{member.mention} に {points} 🪙 ポイントをプレゼントしました。相手の現在のポイント: {user_points[member.id]} 🪙')
+            user_store.add_points(giver_id, -points)
+        mark_dirty()  # 変更を記録（保存はまとめて行う）
+        await interaction.response.send_message(f'{member.mention} に {points} 🪙 ポイントをプレゼントしました。相手の現在のポイント: {user_store.get_points(member.id)} 🪙')
     else:
-        await interaction.response.send_message(f'ポイントが足りません。現在の所持ポイント: {user_points[giver_id]} 🪙', ephemeral=True)
+        await interaction.response.send_message(f'ポイントが足りません。現在の所持ポイント: {user_store.get_points(giver_id)} 🪙', ephemeral=True)
+
+class NameCache:
+    """ユーザーID → 表示名 のキャッシュ（有効期限つき、JSONファイルに保存）"""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.names = {}  # user_id -> (表示名, 取得した時刻)
+        self.changed = False
+
+    def get(self, user_id):
+        """(表示名, 期限内かどうか) を返す。覚えていなければ (None, False)"""
+        entry = self.names.get(user_id)
+        if entry is None:
+            return None, False
+        name, fetched_at = entry
+        return name, time.time() - fetched_at < self.ttl
+
+    def put(self, user_id, name):
+        entry = self.names.get(user_id)
+        now = time.time()
+        if entry is not None and entry[0] == name and now - entry[1] < self.ttl / 2:
+            return  # 同じ名前で十分新しければ書き直さない
+        self.names[user_id] = (name, now)
+        self.changed = True
+
+    def load(self):
+        """ファイルから読み込む（I/Oスレッドで実行）"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.error(f"表示名キャッシュの読み込みに失敗しました: {e}")
+            return
+        for user_id, (name, fetched_at) in data.items():
+            self.names.setdefault(int(user_id), (name, fetched_at))
+
+    def take_snapshot(self):
+        """保存する内容を取り出す（変更がなければ None）"""
+        if not self.changed:
+            return None
+        self.changed = False
+        return json.dumps({str(k): v for k, v in self.names.items()}, ensure_ascii=False).encode("utf-8")
+
+name_cache = NameCache(NAME_CACHE_FILE, NAME_CACHE_TTL_SECONDS)
+name_fetch_semaphore = asyncio.Semaphore(NAME_FETCH_CONCURRENCY)
+name_fetch_tasks = {}  # 取得中のユーザーID -> タスク（同じユーザーを重ねて取得しない）
+
+async def save_name_cache():
+    data = name_cache.take_snapshot()
+    if data is None:
+        return
+    try:
+        await asyncio.get_running_loop().run_in_executor(io_executor, atomic_write, name_cache.path, data)
+    except OSError as e:
+        logging.error(f"表示名キャッシュの保存に失敗しました: {e}")
+        name_cache.changed = True
+
+async def fetch_user_name(user_id):
+    """REST でユーザー名を取得してキャッシュに入れる（同時実行数は NAME_FETCH_CONCURRENCY まで）"""
+    try:
+        async with name_fetch_semaphore:
+            user = await bot.fetch_user(user_id)
+    except discord.HTTPException:
+        return None
+    except Exception as e:
+        # 接続エラーなどでもランキングの表示は止めず、キャッシュの名前か Unknown User で表示する
+        logging.warning(f"ユーザー名を取得できませんでした: {user_id} ({e!r})")
+        return None
+    finally:
+        name_fetch_tasks.pop(user_id, None)
+    name_cache.put(user_id, user.name)  # display_nameではなくnameを使用する
+    return user.name
+
+async def resolve_display_names(guild, user_ids):
+    """ユーザーID → 表示名 をまとめて解決する。
+    メンバーキャッシュ → 表示名キャッシュ → REST の順に探し、REST は並行して呼ぶ。
+    REST が NAME_FETCH_TIMEOUT 以内に返らなければ古いキャッシュの名前を使い、取得は裏で続けてキャッシュを更新する。
+    """
+    names = {}
+    pending = {}
+    for user_id in user_ids:
+        member = guild.get_member(user_id) if guild else None
+        if member:
+            names[user_id] = member.display_name
+            name_cache.put(user_id, member.display_name)
+            continue
+        cached, fresh = name_cache.get(user_id)
+        if fresh:
+            names[user_id] = cached
+            continue
+        names[user_id] = cached or "Unknown User"
+        task = name_fetch_tasks.get(user_id)
+        if task is None:
+            task = name_fetch_tasks[user_id] = asyncio.create_task(fetch_user_name(user_id))
+        pending[task] = user_id
+    if pending:
+        done, _ = await asyncio.wait(pending, timeout=NAME_FETCH_TIMEOUT)
+        for task in done:
+            name = task.result()
+            if name is not None:
+                names[pending[task]] = name
+    return names
+
+PERIOD_NAMES = {"total": "累計", "daily": "今日", "weekly": "今週", "monthly": "今月"}
+KIND_NAMES = {"points": "獲得ポイント", "messages": "メッセージ数"}
 
 # ランキングの部分を以下に修正
 @bot.tree.command(name="ランキング", description="所持ポイント数のランキングを表示します")
-async def ranking(interaction: discord.Interaction):
+@app_commands.describe(period="集計する期間（既定は累計の所持ポイント）", kind="今日・今週・今月のランキングで比べるもの")
+@app_commands.choices(
+    period=[app_commands.Choice(name=name, value=value) for value, name in PERIOD_NAMES.items()],
+    kind=[app_commands.Choice(name=name, value=value) for value, name in KIND_NAMES.items()],
+)
+async def ranking(interaction: discord.Interaction, period: str = "total", kind: str = "points"):
     guild = interaction.guild  # サーバー（ギルド）情報を取得
-    rankings = sorted([(user_id, points) for user_id, points in user_points.items() if user_id not in ADMIN_USER_IDS], key=lambda x: x[1], reverse=True)[:5]
-    response = "**ポイントランキング**\n"
-    for i, (user_id, points) in enumerate(rankings):
-        member = guild.get_member(user_id)
-        if member:
-            display_name = member.display_name
-        else:
-            try:
-                user = await bot.fetch_user(user_id)
-                display_name = user.name  # display_nameではなくnameを使用する
-            except:
-                display_name = "Unknown User"
-        response += f'{i+1}. {display_name}: {points} 🪙\n'
+    if period == "total":
+        if kind == "messages":
+            await interaction.response.send_message("メッセージ数のランキングは今日・今週・今月から選んでください", ephemeral=True)
+            return
+        rankings = user_store.leaderboard.top(5)
+        title = "**ポイントランキング**\n"
+        unit = "🪙"
+    else:
+        today = clock_for(interaction.guild_id).today()
+        rankings = activity_log.top(kind, period_start(period, today), today, 5)
+        title = f"**{PERIOD_NAMES[period]}の{KIND_NAMES[kind]}ランキング**\n"
+        unit = "🪙" if kind == "points" else "件"
+    names = await resolve_display_names(guild, [user_id for user_id, _ in rankings])
+    response = title
+    for i, (user_id, value) in enumerate(rankings):
+        response += f'{i+1}. {names[user_id]}: {value} {unit}\n'
+    if not rankings:
+        response += "まだ記録がありません\n"
+    await interaction.response.send_message(response, ephemeral=True)
+
+
+LEADERBOARD_PAGE_SIZE = 10
+LEADERBOARD_NEIGHBOURS = 2  # /順位 で前後に表示する人数
+LEADERBOARD_PAGE_CACHE_SIZE = 256
+
+leaderboard_page_cache = {}  # (ギルドID, ページ) -> 表示する文字列
+leaderboard_page_cache_key = None  # キャッシュを作ったときの (ランキング, version)
+
+def leaderboard_page_count():
+    return max(1, -(-len(user_store.leaderboard) // LEADERBOARD_PAGE_SIZE))
+
+async def render_leaderboard_page(guild, page):
+    """ランキングの page ページ目（0始まり）の文字列を作る。
+    ランキングの version が変わるまでは同じ文字列を使い回す"""
+    global leaderboard_page_cache_key
+    board = user_store.leaderboard
+    if leaderboard_page_cache_key != (board, board.version):
+        leaderboard_page_cache.clear()
+        leaderboard_page_cache_key = (board, board.version)
+    cache_key = (guild.id if guild else None, page)
+    text = leaderboard_page_cache.get(cache_key)
+    if text is not None:
+        return text
+    version = board.version
+    start = page * LEADERBOARD_PAGE_SIZE
+    rankings = board.entries(start, LEADERBOARD_PAGE_SIZE)
+    names = await resolve_display_names(guild, [user_id for user_id, _ in rankings])
+    text = f"**ポイントランキング（{page + 1}/{leaderboard_page_count()} ページ）**\n"
+    for i, (user_id, points) in enumerate(rankings, start + 1):
+        text += f'{i}. {names[user_id]}: {points} 🪙\n'
+    if not rankings:
+        text += "まだ誰もランキングに載っていません\n"
+    # 名前を待っている間にランキングが変わっていたら、古い内容なのでキャッシュしない
+    if user_store.leaderboard is board and board.version == version:
+        if len(leaderboard_page_cache) >= LEADERBOARD_PAGE_CACHE_SIZE:
+            leaderboard_page_cache.clear()
+        leaderboard_page_cache[cache_key] = text
+    return text
+
+class LeaderboardView(discord.ui.View):
+    """ランキング一覧のページ送りボタン"""
+
+    def __init__(self, page):
+        super().__init__(timeout=300)
+        self.page = page
+        self.update_buttons()
+
+    def update_buttons(self):
+        self.previous_page.disabled = self.page <= 0
+        self.next_page.disabled = self.page >= leaderboard_page_count() - 1
+
+    async def show(self, interaction, page):
+        self.page = max(0, min(page, leaderboard_page_count() - 1))
+        self.update_buttons()
+        text = await render_leaderboard_page(interaction.guild, self.page)
+        await interaction.response.edit_message(content=text, view=self)
+
+    @discord.ui.button(label="◀ 前へ", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(label="次へ ▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.page + 1)
+
+@bot.tree.command(name="ランキング一覧", description="全員のポイントランキングをページごとに表示します")
+@app_commands.describe(page="表示するページ（1から）")
+async def ranking_pages(interaction: discord.Interaction, page: int = 1):
+    page = max(0, min(page - 1, leaderboard_page_count() - 1))
+    text = await render_leaderboard_page(interaction.guild, page)
+    await interaction.response.send_message(text, view=LeaderboardView(page), ephemeral=True)
+
+@bot.tree.command(name="順位", description="自分（または指定したメンバー）の順位と前後のメンバーを表示します")
+@app_commands.describe(member="順位を確認するメンバー")
+async def my_rank(interaction: discord.Interaction, member: discord.Member = None):
+    target = member or interaction.user
+    board = user_store.leaderboard
+    points = user_store.get_points(target.id)
+    rank = board.rank(target.id, points)
+    if rank is None:
+        await interaction.response.send_message(f'{target.mention} はまだランキングに載っていません', ephemeral=True)
+        return
+    start = max(0, rank - 1 - LEADERBOARD_NEIGHBOURS)
+    neighbours = board.entries(start, rank - start + LEADERBOARD_NEIGHBOURS)
+    names = await resolve_display_names(interaction.guild, [user_id for user_id, _ in neighbours])
+    response = f'{target.mention} の順位: **{rank}位** / {len(board)}人中（{points} 🪙）\n'
+    for i, (user_id, user_points) in enumerate(neighbours, start + 1):
+        line = f'{i}. {names[user_id]}: {user_points} 🪙'
+        if user_id == target.id:
+            line = f'**{line}** ◀'
+        response += line + '\n'
     await interaction.response.send_message(response, ephemeral=True)
 
 
@@ -219,9 +2189,11 @@ async def ranking(interaction: discord.Interaction):
 async def show_commands_description(interaction: discord.Interaction):
     commands_list = """
     **使用可能なコマンド一覧**
-    /ポイント - 現在のポイントを表示 🪙
+    /ポイント - 現在のポイントと今日・今週・今月のメッセージ数を表示 🪙
     /ポイント贈答 - 他のメンバーにポイントをプレゼント 🎁
-    /ランキング - 所持ポイント数のランキングを表示 👑
+    /ランキング - 所持ポイント数のランキングを表示 👑（今日・今週・今月の獲得ポイントやメッセージ数も選べます）
+    /ランキング一覧 - 全員のランキングをページ送りで表示 📜
+    /順位 - 自分の順位と前後のメンバーを表示 🏅
     /コマンド_説明 - 使用できるコマンド一覧とポイントの説明を表示
     /ショップ - 商品交換リンクを表示 🛒
     これらのコマンドを送ると、ワレカラくんがあなただけに見えるメッセージを送ります📩（ポイント贈答は他のメンバーにも見えます）
@@ -245,26 +2217,29 @@ async def shop(interaction: discord.Interaction):
 @app_commands.describe(member="ポイントを減算するメンバー", points="減算するポイント数")
 async def subtract_points(interaction: discord.Interaction, member: discord.Member, points: int):
     if interaction.user.id in ADMIN_USER_IDS:
-        user_points[member.id] -= points
-        save_data()  # データの保存
-        await member.send(f'{interaction.user.name}が{points}ポイントを引きました。')
+        user_store.add_points(member.id, -points)
+        mark_dirty()  # 変更を記録（保存はまとめて行う）
+        dm_dispatcher.send(member.id, f'{interaction.user.name}が{points}ポイントを引きました。', user=member)
         await interaction.response.send_message(f'{member.mention}のポイントが{points}減りました。', ephemeral=True)
     else:
         await interaction.response.send_message('このコマンドを実行する権限がありません。', ephemeral=True)
 
-if __name__ == "__main__":
-    from http.server import HTTPServer, BaseHTTPRequestHandler
-    import threading
-
-    class SimpleHTTPRequestHandler(BaseHTTPRequestHandler):
-        def do_GET(self):
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"Server is running")
+def run_data_command(command, path):
+    """データのJSON形式での書き出し（export）・取り込み（import）"""
+    state = storage.read_state()
+    if command == "export":
+        write_json_state(path, state)
+        logging.info(f"{path} に {len(state)} 人分を書き出しました")
+    else:
+        state = read_json_state(path)
+        storage.import_state(state)
+        logging.info(f"{path} から {len(state)} 人分を取り込みました")
+    storage.close()
 
-    def run_server():
-        server = HTTPServer(('0.0.0.0', 8000), SimpleHTTPRequestHandler)
-        server.serve_forever()
+if __name__ == "__main__":
+    # python bot.py export [ファイル名] / python bot.py import [ファイル名]
+    if len(sys.argv) > 1 and sys.argv[1] in ("export", "import"):
+        run_data_command(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else DATA_FILE)
+        sys.exit(0)
 
-    threading.Thread(target=run_server).start()
     bot.run(DISCORD_BOT_TOKEN)